@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import json
+import logging
+import multiprocessing
+import pathlib
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import choice_lib as cl
+import count_lib as ctl
+import gamma_lib as gl
+import metrics_lib as mtl
+import model_lib as ml
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+STAGES = ['variants', 'predict', 'choose', 'count', 'gamma']
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+_READ_TAIL = b'GTTTTAGAGCTAGAAATAGCAAGTT'
+
+def parse_args():
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      '--sizes', type=str,
+      help='comma-separated list of genome sizes (# of loci) to benchmark',
+      default='50,200,800')
+  parser.add_argument(
+      '--targets_per_locus', type=int,
+      help='int: # of synthetic targets per locus',
+      default=40)
+  parser.add_argument(
+      '--pool_per_locus', type=int,
+      help='int: # of guides per locus in the synthetic guide pool',
+      default=100)
+  parser.add_argument(
+      '--reads_per_guide', type=int,
+      help='int: mean # of reads per guide in the synthetic FASTQ files',
+      default=200)
+  parser.add_argument(
+      '--stages', type=str,
+      help='comma-separated subset of: ' + ','.join(STAGES),
+      default=','.join(STAGES))
+  parser.add_argument(
+      '--engine', type=str, choices=['seqio', 'stream', 'batch'],
+      help='count_guides.py engine for the count stage',
+      default='batch')
+  parser.add_argument(
+      '--jobs', type=int,
+      help='int: --jobs passed to the stages that take it',
+      default=1)
+  parser.add_argument(
+      '--seed', type=int,
+      help='int: seed for the synthetic inputs',
+      default=0)
+  parser.add_argument(
+      '--workdir', type=str,
+      help='dir: where to put synthetic inputs (default: a temporary dir)',
+      default=None)
+  parser.add_argument(
+      '--outfile', type=str,
+      help='file: TSV of results (- for stdout)',
+      default='-')
+  args = parser.parse_args()
+  args.sizes = [int(x) for x in args.sizes.split(',')]
+  args.stages = args.stages.split(',')
+  for stage in args.stages:
+    if stage not in STAGES:
+      parser.error('unknown stage: {stage}'.format(**locals()))
+  return args
+
+def random_spacers(rng, n):
+  """n random 20-mers as an 'S20' array."""
+  codes = rng.integers(0, 4, size=(n, ml._GUIDELEN))
+  return _BASES[codes].view('S20').ravel()
+
+def write_lines(filename, lines):
+  with open(filename, 'wb') as handle:
+    handle.write(b'\n'.join(lines) + b'\n')
+
+def make_inputs(workdir, n_loci, args):
+  """Write synthetic inputs for a genome of n_loci to workdir."""
+  rng = np.random.default_rng([args.seed, n_loci])
+  workdir.mkdir(parents=True, exist_ok=True)
+  paths = dict((k, workdir / v) for k, v in [
+      ('targets', 'targets.all.tsv'), ('loci', 'loci'),
+      ('guides', 'guidepool'), ('controls', 'controls'),
+      ('start', 'start.fastq'), ('end', 'end.fastq')])
+  per = args.targets_per_locus
+  loci = np.array(['BSU{0:05d}'.format(10 * (i + 1)) for i in range(n_loci)])
+  targets = random_spacers(rng, n_loci * per)
+  frame = pd.DataFrame({
+      'locus_tag': np.repeat(loci, per),
+      'offset': np.tile(np.arange(per) * 15, n_loci) + rng.integers(0, 15, n_loci * per),
+      'target': targets.astype(str),
+      'pam': 'AGG',
+      'chrom': 'NC_000964.3',
+      'transdir': np.where(rng.random(n_loci * per) < 0.8, 'anti', 'sense')})
+  frame['start'] = np.arange(len(frame)) * 50
+  frame['end'] = frame.start + ml._GUIDELEN
+  frame['repldir'] = 'fwd'
+  frame['weakness'] = 0
+  frame['specificity'] = 39
+  frame = frame[['locus_tag', 'offset', 'target', 'pam', 'chrom', 'start',
+                 'end', 'repldir', 'transdir', 'weakness', 'specificity']]
+  frame.to_csv(paths['targets'], sep='\t', index=False)
+  write_lines(paths['loci'], [x.encode() for x in loci])
+  # guide pool: single mismatch variants of targets, plus parents and controls
+  n_pool = n_loci * args.pool_per_locus
+  pool = np.frombuffer(targets[rng.integers(0, len(targets), n_pool)].tobytes(),
+                       dtype=np.uint8).reshape(n_pool, ml._GUIDELEN).copy()
+  pool[np.arange(n_pool), rng.integers(0, ml._GUIDELEN, n_pool)] = (
+      _BASES[rng.integers(0, 4, n_pool)])
+  controls = random_spacers(rng, max(n_pool // 100, 2))
+  pool = np.unique(np.concatenate([pool.view('S20').ravel(), targets, controls]))
+  write_lines(paths['guides'], list(pool))
+  write_lines(paths['controls'], list(controls))
+  # reads: lognormal abundance at start, random fitness effect at end
+  abundance = rng.lognormal(0, 1, len(pool))
+  abundance /= abundance.mean()
+  fitness = np.where(np.isin(pool, controls), 1.0, rng.uniform(0.2, 1.0, len(pool)))
+  for key, weights in (('start', abundance), ('end', abundance * fitness)):
+    n_reads = args.reads_per_guide * len(pool)
+    picks = rng.choice(len(pool), n_reads, p=weights / weights.sum())
+    with open(paths[key], 'wb') as handle:
+      for first in range(0, n_reads, ctl.CHUNK_SIZE):
+        block = pool[picks[first:first+ctl.CHUNK_SIZE]]
+        handle.write(b''.join(b'@r\n' + s + _READ_TAIL + b'\n+\n' +
+                              b'J' * (len(s) + len(_READ_TAIL)) + b'\n'
+                              for s in block))
+  return paths
+
+def run_variants(paths, args, metrics):
+  targets = pd.read_csv(paths['targets'], sep='\t')
+  loci = set(pd.read_csv(paths['loci'], header=None)[0])
+  parents = cl.filter_targets(targets, loci).target
+  with metrics.stage('run'):
+    items = len(cl.all_single_variants(parents))
+  return items
+
+def run_predict(paths, args, metrics):
+  targets = pd.read_csv(paths['targets'], sep='\t')
+  loci = set(pd.read_csv(paths['loci'], header=None)[0])
+  pairs = cl.build_pairs(cl.filter_targets(targets, loci), loci)
+  with metrics.stage('run'):
+    items = len(ml.predict_mismatch_scores(pairs))
+  return items
+
+def run_choose(paths, args, metrics):
+  import choose_guides
+  outfile = paths['loci'].with_name('chosen.tsv')
+  sys.argv = ['choose_guides.py', '--targetfile', str(paths['targets']),
+              '--locifile', str(paths['loci']), '--outfile', str(outfile),
+              '--jobs', str(args.jobs)]
+  with metrics.stage('run'):
+    choose_guides.main()
+  return len(pd.read_csv(paths['loci'], header=None))
+
+def run_count(paths, args, metrics):
+  import count_guides
+  items = 0
+  for key in ('start', 'end'):
+    sys.argv = ['count_guides.py', '--guide_set', str(paths['guides']),
+                '--input_fastq', str(paths[key]), '--engine', args.engine,
+                '--jobs', str(args.jobs)]
+    with metrics.stage('run'):
+      count_guides.main()
+    items += sum(1 for _ in open(paths[key], 'rb')) // 4
+  return items
+
+def run_gamma(paths, args, metrics):
+  controls = gl.get_controlset(paths['controls'])
+  start, end = [str(paths[k]) + '.counts' for k in ('start', 'end')]
+  if not (pathlib.Path(start).exists() and pathlib.Path(end).exists()):
+    run_count(paths, args, mtl.Metrics())
+  with metrics.stage('run'):
+    frame = gl.compute_gamma(start, end, controls, 10)
+  return len(frame)
+
+_RUNNERS = dict(variants=run_variants, predict=run_predict,
+                choose=run_choose, count=run_count, gamma=run_gamma)
+
+def run_stage(stage, paths, args, metricsfile):
+  """Run one stage, writing its metrics (with an items counter) as JSON."""
+  logging.disable(logging.INFO)
+  metrics = mtl.Metrics(stage)
+  items = _RUNNERS[stage](paths, args, metrics)
+  metrics.count('items', items, stage='run')
+  metrics.finish(metricsfile)
+
+def measure_stage(context, stage, paths, args):
+  """Run stage in a fresh process; returns (seconds, items, peak RSS in MB).
+
+  The process is not daemonic, so stages may start worker pools of their
+  own; peak RSS covers the stage's process and any such workers.
+  """
+  metricsfile = paths['loci'].with_name(stage + '.metrics.json')
+  process = context.Process(target=run_stage,
+                            args=(stage, paths, args, str(metricsfile)))
+  process.start()
+  process.join()
+  if process.exitcode != 0:
+    template = 'Stage {stage} failed with exit code {process.exitcode}'
+    logging.fatal(template.format(**locals()))
+    sys.exit(2)
+  with open(metricsfile, 'r') as handle:
+    summary = json.load(handle)
+  peak = max(summary['peak_rss_mb'], summary['children_peak_rss_mb'])
+  return (summary['stages']['run']['seconds'],
+          summary['counters']['items'], peak)
+
+def main():
+  args = parse_args()
+  tempdir = None
+  if args.workdir is None:
+    tempdir = tempfile.TemporaryDirectory(prefix='mismatch_crispri_bench.')
+    args.workdir = tempdir.name
+  workdir = pathlib.Path(args.workdir)
+  # every stage runs in a fresh process so peak RSS is its own
+  context = multiprocessing.get_context('spawn')
+  rows = list()
+  for n_loci in args.sizes:
+    template = 'Generating synthetic inputs for {n_loci} loci...'
+    logging.info(template.format(**locals()))
+    paths = make_inputs(workdir / 'loci_{0}'.format(n_loci), n_loci, args)
+    for stage in args.stages:
+      template = 'Running {stage} for {n_loci} loci...'
+      logging.info(template.format(**locals()))
+      seconds, items, peak = measure_stage(context, stage, paths, args)
+      rows.append((stage, n_loci, items, seconds, items / max(seconds, 1e-9),
+                   peak))
+  columns = ['stage', 'loci', 'items', 'seconds', 'items_per_sec',
+             'peak_rss_mb']
+  results = pd.DataFrame(rows, columns=columns)
+  # log-log slope of time against items since the previous size; ~1 is linear
+  def scaling(group):
+    ratio = np.log(group.seconds.values[1:] / group.seconds.values[:-1])
+    ratio /= np.log(group['items'].values[1:] / group['items'].values[:-1])
+    return pd.Series(np.concatenate([[np.nan], ratio]), index=group.index)
+  results['scaling'] = np.nan
+  for stage, group in results.groupby('stage', sort=False):
+    results.loc[group.index, 'scaling'] = scaling(group)
+  outfile = sys.stdout if args.outfile == '-' else args.outfile
+  results.to_csv(outfile, sep='\t', index=False, float_format='%.4g')
+  if tempdir is not None:
+    tempdir.cleanup()
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # Author: John Hawkins (jsh) [really@gmail.com]
 
+import bisect
 from collections import Counter
 import logging
 import random
@@ -13,6 +14,8 @@ BASES = 'ACGT'
 BIN_MIN = 0.1
 BIN_MAX = 0.9
 NBINS = 5
+_DECODE_BLOCK = 1 << 16
+INDEX_COLUMNS = ['variant', 'original', 'locus_tag', 'pam', 'y_pred']
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -25,134 +28,188 @@ def bin_preds(preds, bins):
   bins = np.digitize(preds, bins)
   return bins
 
-def pick_n_parents(locus_preds, locus_targets, n):
+def pick_n_parents(locus_preds, locus_targets, n, rng=random):
+  """Yield n parents for a locus, repeating families only when necessary.
+
+  Candidates are taken in offset order and skipped (to the fallback pool)
+  when within 20bp of an already chosen target.  Once exhausted, fallback
+  picks are drawn at random, and after that existing families are boosted
+  round-robin at random.
+  """
   chosen = Counter()
-  offset_map = locus_targets[['target', 'offset']]
-  offset_map.columns = ['original', 'offset']
-  offset_map.set_index('original', inplace=True)
   fullset = set(locus_preds.original.unique())
-  past_picks = set()
-  unused_picks = fullset - past_picks
-  fallback_picks = set()
-  # auto-include past picks but skip pre-filtered
-  chosen.update(past_picks.intersection(fullset))
-  while sum(chosen.values()) < n:
-    used_offsets = offset_map.loc[offset_map.index.intersection(chosen.keys())]
-    mask = offset_map.index.intersection(unused_picks)
-    unused_offsets = offset_map.loc[mask]
-    unused_offsets = unused_offsets.sort_values('offset')
-    if unused_picks:
-      candidate = unused_offsets.iloc[0]
-      unused_picks.remove(candidate.name)
-      unused_offsets = unused_offsets.iloc[1:]
-      offset_diffs = used_offsets.offset - candidate.offset
-      if (offset_diffs.abs() < 20).any():
-        fallback_picks.add(candidate.name)
-      else:
-        chosen[candidate.name] += 1
-    elif fallback_picks:
-      pick = random.sample(fallback_picks, 1)[0]
-      chosen[pick] += 1
-      fallback_picks.remove(pick)
+  targets = locus_targets.loc[locus_targets.target.isin(fullset)]
+  offsets = targets.offset.values
+  order = np.argsort(offsets, kind='stable')
+  names = targets.target.values[order]
+  offsets = offsets[order]
+  name_offsets = dict()
+  for name, offset in zip(names, offsets):
+    name_offsets.setdefault(name, list()).append(offset)
+  used = list()
+  fallback_picks = list()
+  total = 0
+  for candidate in name_offsets:
+    if total >= n:
+      break
+    offset = name_offsets[candidate][0]
+    i = bisect.bisect_right(used, offset - 20)
+    if i < len(used) and used[i] < offset + 20:
+      fallback_picks.append(candidate)
     else:
-      ceiling = chosen.most_common(1)[0][-1] # most common count
-      floor = chosen.most_common()[-1][-1] # least common count
-      while True:
-        # pick elements until we find one with sub-cap count (or we're level)
-        boost = random.choice(chosen.most_common())
-        if (floor == ceiling) or (boost[1] < ceiling):
-          chosen[boost[0]] += 1
-          break
-  if chosen.most_common(1)[0][-1] > 4:
+      chosen[candidate] += 1
+      total += 1
+      for used_offset in name_offsets[candidate]:
+        bisect.insort(used, used_offset)
+  fallback_picks.sort()
+  while total < n and fallback_picks:
+    pick = fallback_picks.pop(rng.randrange(len(fallback_picks)))
+    chosen[pick] += 1
+    total += 1
+  if total < n and chosen:
+    # boost families below the current ceiling, or any family when level
+    ceiling = max(chosen.values())
+    below = [k for k, v in chosen.items() if v < ceiling]
+    while total < n:
+      if not below:
+        ceiling += 1
+        below = list(chosen)
+      i = rng.randrange(len(below))
+      below[i], below[-1] = below[-1], below[i]
+      boost = below.pop()
+      chosen[boost] += 1
+      total += 1
+  if chosen and chosen.most_common(1)[0][-1] > 4:
     # 5*10 + 13 > 60, so warn if we see 5+ instances
     template = 'Had to fall back to same family too often: {chosen}'
     logging.warn(template.format(**locals()))
   for ele in chosen.elements():
     yield ele
 
-def choose_n_for_each(parents, preds, n):
+def choose_n_for_each(parents, preds, n, rng=random):
   chosen = set()
+  if preds.empty:
+    return chosen
+  locus = preds.locus_tag.iloc[0]
+  usable = preds.dropna()
+  variants = usable.variant.values
+  bins = bin_preds(usable.y_pred.values, pred_bins())
+  families = usable.groupby('original', sort=False, observed=True).indices
   for parent in parents:
-    needed = n
-    family_preds = preds.loc[preds.original == parent]
-    used_mask = family_preds.variant.isin(chosen)
-    family_remaining = family_preds.loc[~used_mask]
-    picks = choose_n_by_pred(family_remaining, needed)
+    rows = families.get(parent, np.array([], dtype=int))
+    unused = np.fromiter((v not in chosen for v in variants[rows]), dtype=bool,
+                         count=len(rows))
+    rows = rows[unused]
+    picks = _choose_by_bin(variants[rows], bins[rows], n, rng, locus)
     chosen.update(picks)
   return chosen
 
-def choose_n_by_pred(preds, n):
-  return choose_n_by_bin(preds, 'y_pred', n)
+def choose_n_by_pred(preds, n, rng=random):
+  return choose_n_by_bin(preds, 'y_pred', n, rng)
 
-def choose_n_by_bin(data, binnable, n):
+def choose_n_by_bin(data, binnable, n, rng=random):
+  """Pick n variants spread across prediction bins (see _choose_by_bin)."""
   if data.empty:
     return set()
-  loci = set(data.locus_tag.unique())
-  locus = list(loci)[0]
+  loci = data.locus_tag.unique()
+  locus = loci[0]
   if len(loci) != 1:
+    loci = set(loci)
     template = 'choose_n_by_bin called with multiple loci: {loci}'
     logging.fatal(template.format(**locals()))
     sys.exit(2)
+  if data.shape[0] < n:
+    template = 'Fewer than {n} guides exist for locus {locus}'
+    logging.warning(template.format(**locals()))
   usable = data.dropna()
-  usable = usable.copy()
-  if usable.shape[0] < n:
-    n_found = usable.shape[0]
+  bins = bin_preds(usable[binnable].values, pred_bins())
+  return _choose_by_bin(usable.variant.values, bins, n, rng, locus)
+
+def _choose_by_bin(variants, bins, n, rng, locus):
+  """Pick n of variants spread across bins.
+
+  Each bin but 0 contributes up to (n-1)//(NBINS-1) variants (one fewer for
+  the top bin), chosen at random; the remainder is filled at random,
+  preferring variants outside the top bin.  All draws derive from rng.
+  """
+  variants, first = np.unique(variants, return_index=True)
+  bins = bins[first]
+  if len(variants) < n:
+    n_found = len(variants)
     template = 'Only found {n_found}/{n} binnable guides for locus {locus}'
     logging.warn(template.format(**locals()))
-    if data.shape[0] < n:
-      template = 'Fewer than {n} guides exist for locus {locus}'
-      logging.warning(template.format(**locals()))
-    return set(usable.variant)
-  # ascribe bins
-  bins = pred_bins()
-  usable['bin'] = bin_preds(usable[binnable], bins)
+    return set(variants)
+  # a random key per variant orders the draws within each bin and overall
+  keys = np.random.default_rng(rng.getrandbits(64)).random(len(variants))
   # choose guides for each bin (skipping 0)
-  chosen = set()
-  bins = list(range(NBINS))
-  per_bin = (n-1) // (len(bins)-1)
-  for b in bins:
-    k = per_bin
-    if b == bins[-1]:
-      k -= 1
-    bin_items = usable.loc[usable.bin == b]
-    if bin_items.shape[0] <= k:
-      # if there aren't more than k items in this bin, grab what we have
-      chosen.update(bin_items.variant)
-    else:
-      # if there are more than k, pick at random
-      poss = set(bin_items.variant) - chosen
-      chosen.update(random.sample(poss, k))
+  per_bin = (n-1) // (NBINS-1)
+  quota = np.full(NBINS, per_bin)
+  quota[0] = 0
+  quota[-1] -= 1
+  order = np.lexsort((keys, bins))
+  ranked_bins = bins[order]
+  rank = np.arange(len(order)) - np.searchsorted(ranked_bins, ranked_bins)
+  taken = np.zeros(len(order), dtype=bool)
+  taken[order] = rank < quota[ranked_bins]
   # How many more do we need?
-  z = (n - len(chosen))
+  z = n - taken.sum()
+  if z < 0:
+    template = 'Bin quotas for locus {locus} exceed {n} guides'
+    raise ValueError(template.format(**locals()))
   # Grab up to z preferring non-max efficacy
-  leftover = set(usable.variant) - chosen
-  toosick = set(usable.loc[usable.bin == bins[-1]].variant)
-  okset = leftover - toosick
-  if len(okset) >= z:
-    chosen.update(random.sample(okset, z))
-  else:
-    chosen.update(okset)
-    dregs = toosick - chosen
-    chosen.update(random.sample(dregs, (z - len(okset))))
+  leftover = np.argsort(keys)
+  leftover = leftover[~taken[leftover]]
+  toosick = bins[leftover] == NBINS-1
+  extra = np.concatenate([leftover[~toosick], leftover[toosick]])[:z]
+  chosen = set(variants[taken])
+  chosen.update(variants[extra])
   assert len(chosen) == n
   return chosen
 
+def single_variants(parent, bases=BASES):
+  children = set()
+  for i in range(len(parent)):
+    for letter in bases:
+      children.add(parent[:i] + letter + parent[i+1:])
+  children.discard(parent)
+  return children
+
+def single_variant_arrays(parents):
+  """Enumerate the single-substitution children of each parent as arrays.
+
+  Returns (parent_idx, variants): the position in parents of each child's
+  parent, and the children as a fixed-width bytes array.  Children are
+  ordered by parent, then position, then base.
+  """
+  parents = np.array(list(parents), dtype=bytes)
+  if parents.size and (parents.dtype.itemsize != 20 or
+                       (np.char.str_len(parents) != 20).any()):
+    raise ValueError('all_single_variants needs 20-base parents')
+  parents = parents.astype('S20')
+  codes = parents.view(np.uint8).reshape(len(parents), 20)
+  bases = np.frombuffer(BASES.encode(), dtype=np.uint8)
+  alts = (codes[:, :, None] != bases[None, None, :])
+  parent_idx, pos, base = np.nonzero(alts)
+  children = codes[parent_idx]
+  children[np.arange(len(children)), pos] = bases[base]
+  return parent_idx, children.view('S20').ravel()
 
 def all_single_variants(parents):
-  pairs = list()
-  for parent in parents:
-    assert len(parent) == 20
-    children = set()
-    for i in range(len(parent)):
-      for letter in BASES:
-        children.add(parent[:i] + letter + parent[i+1:])
-    children.remove(parent)
-    for child in children:
-      pairs.append((parent, child))
-  pairrows = list()
-  for original, variant in pairs:
-    pairrows.append({'original':original, 'variant':variant})
-  return pd.DataFrame(pairrows)
+  """Frame of (original, variant) for every single-substitution child.
+
+  original is categorical over the distinct parents (in order of first
+  appearance).
+  """
+  parents = pd.Series(list(parents), dtype=object)
+  parent_idx, variants = single_variant_arrays(parents)
+  categories = pd.unique(parents)
+  codes = pd.Index(categories).get_indexer(parents)[parent_idx]
+  original = pd.Categorical.from_codes(codes, categories=categories)
+  # decode a block at a time to avoid a full-size unicode intermediate
+  variant = np.empty(len(variants), dtype=object)
+  for i in range(0, len(variants), _DECODE_BLOCK):
+    variant[i:i+_DECODE_BLOCK] = variants[i:i+_DECODE_BLOCK].astype(str)
+  return pd.DataFrame({'original': original, 'variant': variant})
 
 def filter_targets(parentframe, loci):
   antisense_rows = parentframe.loc[parentframe.transdir=='anti']
@@ -164,8 +221,38 @@ def filter_targets(parentframe, loci):
 def build_pairs(targetframe, loci):
   parents = targetframe.target
   origvars = all_single_variants(parents)
-  locmap = targetframe[['target', 'locus_tag']].set_index('target').locus_tag
-  pammap = targetframe[['target', 'pam']].set_index('target').pam
-  origvars['locus_tag'] = origvars.original.map(locmap)
-  origvars['pam'] = origvars.original.map(pammap)
+  # original codes index the distinct targets; find each one's first row
+  rows = np.flatnonzero(~parents.duplicated().values)
+  rows = rows[origvars.original.cat.codes.values]
+  origvars['locus_tag'] = targetframe.locus_tag.values[rows]
+  origvars['pam'] = targetframe.pam.values[rows]
   return origvars
+
+def parent_pairs(targetframe):
+  """Rows pairing each target with itself, as build_pairs would for a parent."""
+  parents = pd.DataFrame({'variant': targetframe.target.values,
+                          'original': targetframe.target.values,
+                          'locus_tag': targetframe.locus_tag.values,
+                          'pam': targetframe.pam.values})
+  parents['y_pred'] = 1.0
+  return parents
+
+def save_variant_index(filename, index, fingerprint=''):
+  """Store the (variant, original, locus_tag, pam, y_pred) rows of index.
+
+  fingerprint identifies the model that produced y_pred.
+  """
+  arrays = dict((k, np.asarray(index[k].values, dtype=str))
+                for k in INDEX_COLUMNS[:-1])
+  arrays['y_pred'] = np.asarray(index.y_pred.values, dtype=float)
+  with open(filename, 'wb') as handle:
+    np.savez_compressed(handle, fingerprint=np.array(fingerprint), **arrays)
+
+def load_variant_index(filename):
+  """Return (index, fingerprint) as written by save_variant_index."""
+  with np.load(filename) as stored:
+    index = pd.DataFrame(dict((k, stored[k]) for k in INDEX_COLUMNS))
+    fingerprint = str(stored['fingerprint'])
+  for column in INDEX_COLUMNS[:-1]:
+    index[column] = index[column].astype(object)
+  return index, fingerprint
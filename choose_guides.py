@@ -4,13 +4,18 @@
 import argparse
 import logging
 import pathlib
+import random
 import sys
 
+import numpy as np
 import pandas as pd
 import ipdb
 
 import choice_lib as cl
+import io_lib as iol
+import metrics_lib as mtl
 import model_lib as ml
+import parallel_lib as pl
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -44,9 +49,34 @@ def parse_args():
       help='Distribute guides within each family instead of each locus.')
   parser.add_argument(
       '--outfile', type=str,
-      help='Distribute guides within each family instead of each locus.',
+      help='file: destination for chosen guides (TSV, or Parquet if named '
+           '.parquet)',
       default=str(TESTDIR / 'test.chosen.guides.tsv'))
+  parser.add_argument(
+      '--variant_index', type=str,
+      help='file: where to save the variant index for compute_gammas.py '
+           '(default: next to --outfile, as .variants.npz)',
+      default=None)
+  parser.add_argument(
+      '--batch_loci', type=int,
+      help='int: design this many loci at a time (0 for all at once)',
+      default=0)
+  parser.add_argument(
+      '--seed', type=int,
+      help='int: seed for the per-locus random choices',
+      default=0)
+  parser.add_argument(
+      '--jobs', type=int,
+      help='int: number of worker processes for locus selection',
+      default=1)
+  parser.add_argument(
+      '--prediction_cache', type=str, nargs='?', const=str(ml.PREDICTION_CACHE),
+      help='dir: reuse/store model predictions in this cache',
+      default=None)
+  mtl.add_metrics_args(parser)
   args = parser.parse_args()
+  if args.variant_index is None:
+    args.variant_index = str(pathlib.Path(args.outfile).with_suffix('.variants.npz'))
   if args.divide_evenly and (args.n % args.families > 0):
     err = '--families:{args.families} not evenly divisible by --n:{args.n}'
     logging.warn(err.format(**locals()))
@@ -56,41 +86,91 @@ def parse_args():
     logging.warn(template.format(**locals()))
   return args
 
-def main():
-  args = parse_args()
-  logging.info('Reading targets from {args.targetfile}...'.format(**locals()))
-  logging.info('Building variants for {args.locifile}...'.format(**locals()))
-  loci = set(pd.read_csv(args.locifile, sep='\t', header=None)[0])
-  targetframe = pd.read_csv(args.targetfile, sep='\t')
-  filtered = cl.filter_targets(targetframe, loci)
-  pair_frame = cl.build_pairs(filtered, loci)
-  pair_frame['y_pred'] = ml.predict_mismatch_scores(pair_frame)
-  all_targets = pd.read_csv(args.targetfile, sep='\t')
-  important = set(pd.read_csv(args.locifile, sep='\t', header=None)[0])
-  chosen_loci = important
-  # loop over locus tags and choose measure
-  guides = dict()
-  for locus in chosen_loci:
+def locus_rng(seed, locus):
+  """Deterministic RNG for one locus, independent of processing order."""
+  return random.Random('{seed}:{locus}'.format(**locals()))
+
+def choose_locus_guides(locus_preds, locus_targets, args, rng=random):
+  parents = cl.pick_n_parents(locus_preds, locus_targets, args.families, rng)
+  if args.divide_evenly:
+    guides_per_parent = args.n // args.families
+    return cl.choose_n_for_each(parents, locus_preds, guides_per_parent, rng)
+  parents = list(parents)
+  candidates = locus_preds.loc[locus_preds.original.isin(parents)]
+  return cl.choose_n_by_pred(candidates, args.n, rng)
+
+def _choose_locus_job(job):
+  locus, locus_preds, locus_targets, args = job
+  rng = locus_rng(args.seed, locus)
+  return choose_locus_guides(locus_preds, locus_targets, args, rng)
+
+def locus_jobs(batch, pair_frame, all_targets, target_rows, args):
+  pair_rows = pair_frame.groupby('locus_tag', sort=False).indices
+  for locus in batch:
     template = 'Examining options for locus_tag: {locus}...'
     logging.info(template.format(**locals()))
-    locus_preds = pair_frame.loc[pair_frame.locus_tag == locus]
-    if len(locus_preds) == 0:
+    if locus not in pair_rows:
       logging.warn('...NO OPTIONS FOUND.')
       continue
-    locus_targets = all_targets.loc[all_targets.locus_tag == locus]
-    parents = cl.pick_n_parents(locus_preds, locus_targets, args.families)
-    if args.divide_evenly:
-      guides_per_parent = args.n // args.families
-      guides[locus] = cl.choose_n_for_each(parents, locus_preds, guides_per_parent)
-    else:
-      parents = list(parents)
-      candidates = locus_preds.loc[locus_preds.original.isin(parents)]
-      guides[locus] = cl.choose_n_by_pred(candidates, args.n)
-  allguides = set()
-  for locus in guides:
-    allguides.update(guides[locus])
-  outframe = pair_frame.loc[pair_frame.variant.isin(allguides)]
-  outframe.to_csv(args.outfile, sep='\t', index=False)
+    locus_preds = pair_frame.iloc[pair_rows[locus]]
+    locus_targets = all_targets.iloc[target_rows[locus]]
+    yield locus, locus_preds, locus_targets, args
+
+def scored_batches(filtered, loci, batch_size, cache=None, metrics=None):
+  """Yield (batch_loci, pair_frame) with predictions, batch_size loci at a time.
+
+  Only one batch of variants is built and scored at a time, so memory scales
+  with the batch rather than the genome.
+  """
+  metrics = metrics or mtl.Metrics()
+  loci = sorted(loci)
+  batch_size = batch_size or max(len(loci), 1)
+  locus_rows = filtered.groupby('locus_tag', sort=False).indices
+  for first in range(0, len(loci), batch_size):
+    batch = loci[first:first+batch_size]
+    rows = [locus_rows[locus] for locus in batch if locus in locus_rows]
+    rows = np.sort(np.concatenate(rows)) if rows else np.array([], dtype=int)
+    with metrics.stage('variants'):
+      pair_frame = cl.build_pairs(filtered.iloc[rows], batch)
+    with metrics.stage('predict'):
+      pair_frame['y_pred'] = ml.predict_mismatch_scores(pair_frame, cache=cache)
+    metrics.count('variants', len(pair_frame), stage='predict')
+    yield batch, pair_frame
+
+def main():
+  args = parse_args()
+  metrics = mtl.Metrics('choose_guides', args.profile)
+  logging.info('Reading targets from {args.targetfile}...'.format(**locals()))
+  logging.info('Building variants for {args.locifile}...'.format(**locals()))
+  with metrics.stage('read_targets'):
+    loci = set(pd.read_csv(args.locifile, sep='\t', header=None)[0])
+    all_targets = pd.read_csv(args.targetfile, sep='\t')
+    filtered = cl.filter_targets(all_targets, loci)
+    target_rows = all_targets.groupby('locus_tag', sort=False).indices
+  cache = None
+  if args.prediction_cache is not None:
+    cache = ml.PredictionCache(args.prediction_cache)
+  index = [cl.parent_pairs(filtered)]
+  with iol.TableWriter(args.outfile) as outfile:
+    for batch, pair_frame in scored_batches(filtered, loci, args.batch_loci,
+                                            cache, metrics):
+      # loop over locus tags and choose measure
+      with metrics.stage('select'):
+        jobs = locus_jobs(batch, pair_frame, all_targets, target_rows, args)
+        allguides = set()
+        for picks in pl.ordered_map(_choose_locus_job, jobs, args.jobs):
+          allguides.update(picks)
+      metrics.count('loci', len(batch), stage='select')
+      with metrics.stage('write'):
+        outframe = pair_frame.loc[pair_frame.variant.isin(allguides)]
+        outfile.write(outframe)
+      index.append(outframe[cl.INDEX_COLUMNS])
+  template = 'Saving variant index to {args.variant_index}...'
+  logging.info(template.format(**locals()))
+  with metrics.stage('write'):
+    index = pd.concat(index, ignore_index=True)
+    cl.save_variant_index(args.variant_index, index, ml.model_fingerprint())
+  metrics.finish(args.metrics)
 
 ##############################################
 if __name__ == "__main__":
@@ -6,10 +6,16 @@ import logging
 import pathlib
 import sys
 
+import numpy as np
 import pandas as pd
 
+import choice_lib as cl
+import count_lib as ctl
 import gamma_lib as gl
+import io_lib as iol
+import metrics_lib as mtl
 import model_lib as ml
+import parallel_lib as pl
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -39,78 +45,187 @@ def parse_args():
       help='file: list of applicable locus_tags',
       default=str(TESTDIR / 'test.loci'))
   parser.add_argument(
-      '--configdir', type=str, help='file: name of directory containing config.tsv',
-      default=str(TESTDIR))
+      '--configdir', type=str, nargs='+',
+      help='file: name of directory containing config.tsv (or several; '
+           'default: testdata, unless --manifest is given)',
+      default=None)
+  parser.add_argument(
+      '--manifest', type=str,
+      help='file: list of further config directories, one per line',
+      default=None)
+  parser.add_argument(
+      '--guide_set', type=str,
+      help='file: guide list given to count_guides.py (needed for .npy counts)',
+      default=None)
+  parser.add_argument(
+      '--variant_index', type=str,
+      help='file: variant index saved by choose_guides.py; if given, used '
+           'instead of rebuilding variants from --targetfile/--locifile',
+      default=None)
   parser.add_argument(
       '--gammafile', type=str,
-      help='file: file to which to write annotated gamma measurements',
+      help='file: file to which to write annotated gamma measurements '
+           '(default: gammas.<table_format> in each config directory)',
       default=None)
+  parser.add_argument(
+      '--table_format', type=str, choices=['tsv', 'parquet'],
+      help='format of the default gamma files (parquet needs pyarrow)',
+      default='tsv')
   parser.add_argument(
       '--growth', type=int,
       help='int: number of generations grown (in other words, g*t)',
       default=10)
+  parser.add_argument(
+      '--prediction_cache', type=str, nargs='?', const=str(ml.PREDICTION_CACHE),
+      help='dir: reuse/store model predictions in this cache',
+      default=None)
+  parser.add_argument(
+      '--jobs', type=int,
+      help='int: number of experiments to process in parallel',
+      default=1)
+  mtl.add_metrics_args(parser)
   args = parser.parse_args()
   # TODO(jsh): Add check that either all or none of these are specified
-  if args.gammafile is None:
-    args.gammafile = pathlib.Path(args.configdir) / 'gammas.tsv'
+  configdirs = args.configdir or list()
+  if args.manifest is not None:
+    configdirs.extend(read_manifest(args.manifest))
+  if args.configdir is None and args.manifest is None:
+    configdirs = [str(TESTDIR)]
+  args.configdir = configdirs
+  if args.gammafile is not None and len(args.configdir) > 1:
+    parser.error('--gammafile only applies to a single config directory')
   return args
 
 
-def flatgamma(stacked_replicates, controls):
-  data = stacked_replicates
-  data['y_pred'] = ml.predict_mismatch_scores(data)
-  data.y_pred = data.y_pred.where(~data.variant.isin(controls), 0.0)
-  anno = data.drop(['rep', 'gamma', 'start_mask'], axis='columns')
-  anno = anno.drop_duplicates()
-  gamma = data[['variant', 'rep', 'gamma']].set_index(['variant', 'rep'])
-  gamma = gamma.unstack(level='rep').mean(axis='columns')
-  data = pd.DataFrame(anno)
-  data.set_index('variant', inplace=True)
-  data['gamma'] = gamma
-  return data
+def read_manifest(manifest):
+  """Config directories listed in manifest, relative to its location."""
+  base = pathlib.Path(manifest).parent
+  configdirs = list()
+  for line in open(manifest, 'r'):
+    line = line.split('#')[0].strip()
+    if line:
+      configdirs.append(str(base / line))
+  return configdirs
 
 
-def count_mismatches(row):
-  n = 0
-  v = row.variant
-  o = row.original
-  for i in range(len(v)):
-    if v[i] != o[i]:
-      n += 1
-  return n
+def flatgamma(summary, controls, cache=None, known=None):
+  """Add a y_pred for each variant to replicate-averaged gammas.
+
+  summary is indexed by variant, with an original column and the gamma
+  columns of gl.ReplicateGammas.summary(); y_pred goes just before them.
+  known, if given, is a Series of y_pred indexed by (variant, original); only
+  pairs missing from it are run through the model.
+  """
+  data = summary.reset_index()
+  if known is None:
+    y_pred = ml.predict_mismatch_scores(data, cache=cache).values
+  else:
+    pairs = pd.MultiIndex.from_arrays([data.variant, data.original])
+    y_pred = np.array(known.reindex(pairs), dtype=float)
+    missing = np.isnan(y_pred)
+    if missing.any():
+      predicted = ml.predict_mismatch_scores(data.loc[missing], cache=cache)
+      y_pred[missing] = predicted.values
+  y_pred = np.where(data.variant.isin(controls), 0.0, y_pred)
+  data = summary.copy()
+  data.insert(data.columns.get_loc('gamma'), 'y_pred', y_pred)
+  return data
 
-def one_or_fewer_mismatches(row):
-  return count_mismatches(row) <= 1
 
 def max_one_mismatch_mask(frame):
-  return frame.apply(one_or_fewer_mismatches, axis='columns')
+  nmm = ml.count_mismatches(frame.variant, frame.original)
+  return pd.Series(nmm <= 1, index=frame.index)
 
 
-def main():
-  args = parse_args()
-  controls = set(pd.read_csv(args.controls, header=None)[0])
-  configdir = pathlib.Path(args.configdir)
+def load_shared(args, metrics):
+  """Load the inputs shared by every experiment."""
+  with metrics.stage('read_inputs'):
+    controls = set(pd.read_csv(args.controls, header=None)[0])
+    guides = None
+    if args.guide_set is not None:
+      guides = ctl.load_guide_index(args.guide_set)
+    known = None
+    if args.variant_index is not None:
+      index, fingerprint = cl.load_variant_index(args.variant_index)
+      if fingerprint == ml.model_fingerprint():
+        known = index.drop_duplicates(['variant', 'original'])
+        known = known.set_index(['variant', 'original']).y_pred
+      else:
+        logging.info('Model changed since the variant index was saved, '
+                     'so predictions will be recomputed.')
+  if args.variant_index is None:
+    logging.info('Building variants for {args.locifile}...'.format(**locals()))
+    with metrics.stage('variants'):
+      index = gl.variant_space(args.targetfile, args.locifile)
+  return dict(args=args, controls=controls, index=index, known=known,
+              read=gl.CountCache(guides))
+
+def compute_experiment(configdir, shared, metrics):
+  """Write annotated and mean gammas for the replicates in configdir."""
+  args = shared['args']
+  controls = shared['controls']
+  configdir = pathlib.Path(configdir)
+  gammafile = pathlib.Path(
+      args.gammafile or configdir / ('gammas.' + args.table_format))
   config = pd.read_csv(configdir / 'config.tsv', sep='\t')
   config = config.set_index('sample')
-  rep_frames = list()
-  for rep, ends in config.iterrows():
-    logging.info('Computing gammas for sample {rep}...'.format(**locals()))
-    start = configdir / ends.start
-    end = configdir / ends.end
-    rep_frame = gl.compute_gamma(start, end, controls, args.growth)
-    rep_frame['rep'] = rep
-    rep_frame = rep_frame.reset_index()
-    rep_frames.append(rep_frame)
-  collected = pd.concat(rep_frames).reset_index(drop=True)
-  variants = collected.variant
-  annoframe = gl.annotate_variants(variants, args.targetfile, args.locifile, args.genbank)
-  annoframe = annoframe.drop('variant', axis='columns')
-  annoframe = pd.concat([collected, annoframe], axis='columns')
-  annoframe.to_csv(args.gammafile, index=False, sep='\t')
-  annoframe = annoframe.loc[max_one_mismatch_mask(annoframe)]
-  flatframe = flatgamma(annoframe, controls)
-  flatfile = pathlib.Path(args.gammafile).with_suffix('.mean.tsv')
-  flatframe.to_csv(flatfile, sep='\t')
+  samples = [(rep, configdir / ends.start, configdir / ends.end)
+             for rep, ends in config.iterrows()]
+  reps = list(config.index)
+  logging.info('Computing gammas for samples {reps}...'.format(**locals()))
+  with metrics.stage('gamma'):
+    gammas = gl.ReplicateGammas(samples, controls, args.growth,
+                                read=shared['read'])
+  metrics.count('guides', gammas.present.sum(), stage='gamma')
+  with metrics.stage('annotate'):
+    annoframe = gl.annotate_variants(gammas.variants, args.targetfile,
+                                     args.locifile, args.genbank,
+                                     shared['index'])
+    # one row per variant, in gammas.variants order
+    annoframe = annoframe.drop_duplicates('variant').set_index('variant')
+    annoframe = annoframe.reindex(gammas.variants).reset_index()
+    stacked = gammas.stacked(annoframe)
+  metrics.count('rows', len(stacked), stage='annotate')
+  with metrics.stage('write_gammas'):
+    iol.write_table(stacked, gammafile)
+  with metrics.stage('flatten'):
+    summary = gammas.summary(annoframe)
+    summary = summary.loc[max_one_mismatch_mask(summary.reset_index()).values]
+    cache = None
+    if args.prediction_cache is not None:
+      cache = ml.PredictionCache(args.prediction_cache)
+    flatframe = flatgamma(summary, controls, cache, shared['known'])
+  with metrics.stage('write_mean'):
+    flatfile = gammafile.with_suffix('.mean' + gammafile.suffix)
+    iol.write_table(flatframe, flatfile, index=True)
+
+_SHARED = None
+
+def _init_worker(shared):
+  global _SHARED
+  _SHARED = shared
+
+def _experiment_job(configdir):
+  metrics = mtl.Metrics()
+  compute_experiment(configdir, _SHARED, metrics)
+  return metrics
+
+def main():
+  args = parse_args()
+  metrics = mtl.Metrics('compute_gammas', args.profile)
+  shared = load_shared(args, metrics)
+  if args.jobs <= 1 or len(args.configdir) <= 1:
+    for configdir in args.configdir:
+      logging.info('Processing {configdir}...'.format(**locals()))
+      compute_experiment(configdir, shared, metrics)
+  else:
+    results = pl.ordered_map(_experiment_job, args.configdir, args.jobs,
+                             _init_worker, (shared,))
+    for configdir, done in zip(args.configdir, results):
+      logging.info('Finished {configdir}.'.format(**locals()))
+      metrics.merge(done)
+  metrics.count('experiments', len(args.configdir))
+  metrics.finish(args.metrics)
 
 ##############################################
 if __name__ == "__main__":
@@ -15,6 +15,9 @@ import sys
 from Bio import SeqIO
 from Bio import Seq
 
+import count_lib as ctl
+import metrics_lib as mtl
+
 
 # logging.basicConfig(level=logging.DEBUG,
 #                     format='%(asctime)s %(levelname)s %(message)s')
@@ -48,6 +51,23 @@ def parse_args():
                       help='Location of front read file in FASTQ format.')
   parser.add_argument('--rear_fastq', type=str, required=True,
                       help='Location of rear read file in FASTQ format.')
+  parser.add_argument('--engine', type=str, choices=['seqio', 'stream'],
+                      default='seqio',
+                      help='seqio: parse with Bio.SeqIO; '
+                           'stream: raw FASTQ lines, read by one thread per '
+                           'mate file and counted by --jobs workers.')
+  parser.add_argument('--skip_budget', type=int, default=ctl.SKIP_BUDGET,
+                      help='Bytes of skipped reads to buffer between writes.')
+  parser.add_argument('--skip_gzip', action='store_true',
+                      help='Write skipped reads gzipped, to .skipped.gz.')
+  parser.add_argument('--skip_sample', type=int, default=0,
+                      help='If positive, only keep a random sample of this '
+                           'many skipped read pairs.')
+  parser.add_argument('--jobs', type=int, default=1,
+                      help='Worker processes for the stream engine.')
+  parser.add_argument('--chunk_size', type=int, default=ctl.CHUNK_SIZE,
+                      help='Read pairs per worker task for the stream engine.')
+  mtl.add_metrics_args(parser)
   args = parser.parse_args()
   # if args.tsv_file_name is None:
   #   base = os.path.splitext(args.input_fasta_genome_name)[0]
@@ -55,21 +75,11 @@ def parse_args():
   return args
 
 
-def main():
-  args = parse_args()
+def count_with_seqio(args, skips):
   front_handle = gzip.open(args.front_fastq, 'rt')
   front_records = SeqIO.parse(front_handle, 'fastq-sanger')
   rear_handle = gzip.open(args.rear_fastq, 'rt')
   rear_records = SeqIO.parse(rear_handle, 'fastq-sanger')
-  outfile = open(args.front_fastq + '.counts', 'w')
-  pairfile = open(args.front_fastq + '.pairs', 'w')
-  frontfile = open(args.front_fastq + '.front', 'w')
-  rearfile = open(args.front_fastq + '.rear', 'w')
-  weirdfile = open(args.front_fastq + '.weird', 'w')
-  skip_front = open(args.front_fastq + '.skipped', 'w')
-  skip_rear = open(args.rear_fastq + '.skipped', 'w')
-  skipped_front = list()
-  skipped_rear = list()
   counts = collections.defaultdict(int)
   sample_fraction = 1./1000
   record_i = 0
@@ -92,58 +102,70 @@ def main():
     # r_endpos = r.find('ACATAGATTA') <-- for old pre-BMK XY library
     r_endpos = r.find('ACATTAAGTA')
     if f_endpos < 0 or f_startpos < 0 or r_endpos < 0 or r_startpos < 0:
-      skipped_front.append(front)
-      skipped_rear.append(rear)
+      skips.add(ctl.record_lines(front), ctl.record_lines(rear))
     else:
       f = str(f[f_startpos:f_endpos])
       r = str(r[r_startpos:r_endpos])
       r = str(Seq.Seq(r).reverse_complement())
       counts[(f, r)] += 1
-    if len(skipped_front) > 10000:
-      logging.info('DUMPING SKIPPED RECORDS')
-      SeqIO.write(skipped_front, skip_front, 'fastq-sanger')
-      SeqIO.write(skipped_rear, skip_rear, 'fastq-sanger')
-      skipped_front = list()
-      skipped_rear = list()
-  logging.info('DUMPING FINAL SKIPPED RECORDS')
-  SeqIO.write(skipped_front, skip_front, 'fastq-sanger')
-  SeqIO.write(skipped_rear, skip_rear, 'fastq-sanger')
-  skipped_front = list()
-  skipped_rear = list()
-  # set up locus_map / expected
-  expected = dict()
-  locus_map = parse_locus_map(args.locus_map)
-  for x in list(locus_map.values()):
-    for y in list(locus_map.values()):
-      expected[(x,y)] = 0
-  front_stats = dict([(x, 0) for x in list(locus_map.values())])
-  rear_stats = dict([(x, 0) for x in list(locus_map.values())])
-  pair_stats = collections.defaultdict(int)
-  for k,v in sorted(iter(list(counts.items())), key=lambda k_v: k_v[1], reverse=True):
-    f, r = k
-    if r not in locus_map or f not in locus_map:
-      weirdfile.write('\t'.join([f, r, str(v)]) + '\n')
-      continue
-    f = locus_map[f]
-    r = locus_map[r]
-    front_stats[f] += v
-    rear_stats[r] += v
-    pair = f <= r and (f,r) or (r,f)
-    pair_stats[pair] += v
-    expected[(f, r)] = v
-  for pair, count in list(expected.items()):
-    a, b = pair
-    outfile.write('\t'.join((a, b, str(count))) + '\n')
-  for pair, count in list(pair_stats.items()):
-    a, b = pair
-    pairfile.write('\t'.join((a, b, str(count))) + '\n')
-  for front, count in list(front_stats.items()):
-    frontfile.write('\t'.join((front, str(count))) + '\n')
-  for rear, count in list(rear_stats.items()):
-    rearfile.write('\t'.join((rear, str(count))) + '\n')
-  # output a tsv
-  SeqIO.write(skipped_front, skip_front, 'fastq-sanger')
-  SeqIO.write(skipped_rear, skip_rear, 'fastq-sanger')
+  return counts
+
+
+def main():
+  args = parse_args()
+  metrics = mtl.Metrics('count_guide_pairs_2021', args.profile)
+  outfile = open(args.front_fastq + '.counts', 'w')
+  pairfile = open(args.front_fastq + '.pairs', 'w')
+  frontfile = open(args.front_fastq + '.front', 'w')
+  rearfile = open(args.front_fastq + '.rear', 'w')
+  weirdfile = open(args.front_fastq + '.weird', 'w')
+  skipnames = [args.front_fastq + '.skipped', args.rear_fastq + '.skipped']
+  skips = ctl.skip_output(skipnames, budget=args.skip_budget,
+                          compress=args.skip_gzip, sample=args.skip_sample)
+  with metrics.stage('count'):
+    if args.engine == 'seqio':
+      counts = count_with_seqio(args, skips)
+    else:
+      counts, _ = ctl.count_fastq_pairs(args.front_fastq, args.rear_fastq,
+                                        skips, jobs=args.jobs,
+                                        chunk_size=args.chunk_size)
+    skips.close()
+  metrics.count('pairs', sum(counts.values()), stage='count')
+  with metrics.stage('read_locus_map'):
+    locus_map = parse_locus_map(args.locus_map)
+  with metrics.stage('tally'):
+    # set up locus_map / expected
+    expected = dict()
+    for x in list(locus_map.values()):
+      for y in list(locus_map.values()):
+        expected[(x,y)] = 0
+    front_stats = dict([(x, 0) for x in list(locus_map.values())])
+    rear_stats = dict([(x, 0) for x in list(locus_map.values())])
+    pair_stats = collections.defaultdict(int)
+    for k,v in sorted(iter(list(counts.items())), key=lambda k_v: k_v[1], reverse=True):
+      f, r = k
+      if r not in locus_map or f not in locus_map:
+        weirdfile.write('\t'.join([f, r, str(v)]) + '\n')
+        continue
+      f = locus_map[f]
+      r = locus_map[r]
+      front_stats[f] += v
+      rear_stats[r] += v
+      pair = f <= r and (f,r) or (r,f)
+      pair_stats[pair] += v
+      expected[(f, r)] = v
+  with metrics.stage('write'):
+    for pair, count in list(expected.items()):
+      a, b = pair
+      outfile.write('\t'.join((a, b, str(count))) + '\n')
+    for pair, count in list(pair_stats.items()):
+      a, b = pair
+      pairfile.write('\t'.join((a, b, str(count))) + '\n')
+    for front, count in list(front_stats.items()):
+      frontfile.write('\t'.join((front, str(count))) + '\n')
+    for rear, count in list(rear_stats.items()):
+      rearfile.write('\t'.join((rear, str(count))) + '\n')
+  metrics.finish(args.metrics)
 
 ##############################################
 if __name__ == "__main__":
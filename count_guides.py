@@ -9,9 +9,13 @@ import logging
 import random
 import sys
 
+import numpy as np
 from Bio import SeqIO
 from Bio import Seq
 
+import count_lib as ctl
+import metrics_lib as mtl
+
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -27,21 +31,40 @@ def parse_args():
                       help='Location of read file in FASTQ format.')
   parser.add_argument('--reverse', action='store_true',
                       help='If set, guide is oriented opposite to read direction.')
+  parser.add_argument('--engine', type=str,
+                      choices=['seqio', 'stream', 'batch'], default='seqio',
+                      help='seqio: parse with Bio.SeqIO; '
+                           'stream: raw FASTQ lines, counted in blocks by '
+                           '--jobs workers; '
+                           'batch: as stream, with vectorized spacer search.')
+  parser.add_argument('--dense', action='store_true',
+                      help='Also write .counts.npy, a count array aligned to '
+                           'the order of --guide_set (first occurrences, '
+                           'blank lines dropped).')
+  parser.add_argument('--max_mismatches', type=int, choices=[0, 1], default=0,
+                      help='Assign reads within this many mismatches of a '
+                           'unique guide to that guide.')
+  parser.add_argument('--skip_budget', type=int, default=ctl.SKIP_BUDGET,
+                      help='Bytes of skipped reads to buffer between writes.')
+  parser.add_argument('--skip_gzip', action='store_true',
+                      help='Write skipped reads gzipped, to .skipped.gz.')
+  parser.add_argument('--skip_sample', type=int, default=0,
+                      help='If positive, only keep a random sample of this '
+                           'many skipped reads.')
+  parser.add_argument('--jobs', type=int, default=1,
+                      help='Worker processes for the stream/batch engines.')
+  parser.add_argument('--chunk_size', type=int, default=ctl.CHUNK_SIZE,
+                      help='Reads per worker task for the stream/batch engines.')
+  mtl.add_metrics_args(parser)
   args = parser.parse_args()
   return args
 
 
-def main():
-  args = parse_args()
+def count_with_seqio(args, hitlist, skips):
   if args.input_fastq.endswith('.gz'):
     handle = gzip.open(args.input_fastq, 'rt')
   else:
     handle = open(args.input_fastq, 'r')
-  hitlist = set([x.strip() for x in open(args.guide_set, 'r')])
-  outfile = open(args.input_fastq + '.counts', 'w')
-  weirdfile = open(args.input_fastq + '.weird', 'w')
-  skipfile = open(args.input_fastq + '.skipped', 'w')
-  skipped = list()
   counts = collections.defaultdict(int)
   reads = 0
   for x in hitlist:
@@ -66,26 +89,66 @@ def main():
         s = str(Seq.Seq(s).reverse_complement())
       counts[s] += 1
     else:
-      skipped.append(record)
-    if len(skipped) > 10000:
-      logging.info('DUMPING SKIPPED RECORDS')
-      SeqIO.write(skipped, skipfile, 'fastq-sanger')
-      skipped = list()
-  logging.info('DUMPING FINAL SKIPPED RECORDS')
-  SeqIO.write(skipped, skipfile, 'fastq-sanger')
-  logging.info('Sorting records')
-  for k,v in sorted(iter(counts.items()), key=lambda k_v: k_v[1], reverse=True):
-    if k in hitlist:
-      outfile.write('\t'.join([k, str(v)]) + '\n')
-    else:
-      weirdfile.write('\t'.join([k, str(v)]) + '\n')
+      skips.add(ctl.record_lines(record))
   handle.close()
+  return counts, reads
+
+
+def assign_near_misses(args, counts, hitlist):
+  logging.info('Indexing single-mismatch neighbors of guides...')
+  index, collisions = ctl.build_neighbor_index(hitlist)
+  shared = len(collisions)
+  template = '...{shared} neighbors are shared by multiple guides'
+  logging.info(template.format(**locals()))
+  rescued = sum(v for k, v in counts.items() if k in index)
+  counts, ambiguous = ctl.assign_near_misses(counts, index, collisions)
+  unresolved = sum(ambiguous.values())
+  template = 'Assigned {rescued} near-miss reads, {unresolved} ambiguous'
+  logging.info(template.format(**locals()))
+  with open(args.input_fastq + '.ambiguous', 'w') as ambigfile:
+    for k, v in sorted(ambiguous.items(), key=lambda k_v: k_v[1], reverse=True):
+      guides = ','.join(sorted(collisions[k]))
+      ambigfile.write('\t'.join([k, str(v), guides]) + '\n')
+  return counts
+
+
+def main():
+  args = parse_args()
+  metrics = mtl.Metrics('count_guides', args.profile)
+  with metrics.stage('read_guides'):
+    hitlist = set([x.strip() for x in open(args.guide_set, 'r')])
+  outfile = open(args.input_fastq + '.counts', 'w')
+  weirdfile = open(args.input_fastq + '.weird', 'w')
+  skips = ctl.skip_output([args.input_fastq + '.skipped'],
+                          budget=args.skip_budget, compress=args.skip_gzip,
+                          sample=args.skip_sample)
+  with metrics.stage('count'):
+    if args.engine == 'seqio':
+      counts, reads = count_with_seqio(args, hitlist, skips)
+    else:
+      counts, reads = ctl.count_fastq(args.input_fastq, hitlist, skips,
+                                      reverse=args.reverse, jobs=args.jobs,
+                                      chunk_size=args.chunk_size,
+                                      batch=(args.engine == 'batch'))
+    skips.close()
+  metrics.count('reads', reads, stage='count')
+  if args.max_mismatches:
+    with metrics.stage('near_misses'):
+      counts = assign_near_misses(args, counts, hitlist)
+  logging.info('Sorting records')
+  with metrics.stage('write_counts'):
+    ctl.write_counts(counts, hitlist, outfile, weirdfile)
+    if args.dense:
+      guides = ctl.load_guide_index(args.guide_set)
+      np.save(args.input_fastq + '.counts.npy', ctl.dense_counts(counts, guides))
+  metrics.count('guides', len(counts), stage='write_counts')
   hits = len(hitlist)
   if hits == 0:
-    ratio == 'n/a'
+    ratio = 'n/a'
   else:
     ratio = reads/hits
   logging.info('mean(reads/oligo) = {0}/{1} = {2}'.format(reads, hits, ratio))
+  metrics.finish(args.metrics)
 
 ##############################################
 if __name__ == "__main__":
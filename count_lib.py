@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import collections
+import functools
+import gzip
+import io
+import itertools
+import logging
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import pandas as pd
+
+import choice_lib as cl
+import parallel_lib as pl
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+FORWARD_TAIL = b'GTTTTAGAG'
+REVERSE_HEADER = b'TCTAAAAC'
+SPACER_LEN = 20
+# Paired (front, rear) layout used by count_guide_pairs_2021.py.
+FRONT_START = 1  # first base is always N, locus_map modified to match
+FRONT_TAIL = b'ATAGGGAACT'
+REAR_HEADER = b'GCTCTTAAAC'
+REAR_TAIL = b'ACATTAAGTA'
+CHUNK_SIZE = 100000
+READ_BUFFER = 1 << 20
+SAMPLE_RECORDS = 1000
+SKIP_BUDGET = 1 << 20
+
+# Matches the ambiguous-DNA complement used by Bio.Seq.reverse_complement.
+_COMPLEMENT = bytes.maketrans(b'ACGTMRWSYKVHDBNacgtmrwsykvhdbn',
+                              b'TGCAKYWSRMBDHVNtgcakywsrmbdhvn')
+_COMPLEMENT_LUT = np.frombuffer(_COMPLEMENT, dtype=np.uint8)
+_SPACE_LUT = np.zeros(256, dtype=bool)
+_SPACE_LUT[list(b' \t\n\r\v\f')] = True
+
+
+def is_gzipped(filename):
+  return str(filename).endswith('.gz')
+
+def open_fastq(filename):
+  """Open a (possibly gzipped) FASTQ file for raw binary reading."""
+  if is_gzipped(filename):
+    # GzipFile.readline is slow per line; let a C buffer split the lines
+    return io.BufferedReader(gzip.open(filename, 'rb'), READ_BUFFER)
+  return open(filename, 'rb')
+
+def fastq_chunks(handle, chunk_size=CHUNK_SIZE):
+  """Yield flat lists of FASTQ lines (4 per record), chunk_size records each.
+
+  Blank lines between records are dropped, as Bio.SeqIO does.  Multi-line
+  records are not supported.
+  """
+  pending = list()
+  while True:
+    lines = list(itertools.islice(handle, 4 * chunk_size))
+    if not lines:
+      break
+    pending.extend(line.rstrip() for line in lines if not line.isspace())
+    usable = len(pending) - (len(pending) % 4)
+    if usable:
+      chunk, pending = pending[:usable], pending[usable:]
+      if not all(title.startswith(b'@') for title in chunk[0::4]):
+        raise ValueError('FASTQ record does not start with "@"')
+      yield chunk
+  if pending:
+    raise ValueError('Truncated FASTQ record: {0}'.format(pending[0]))
+
+def _record_start(handle, offset):
+  """Return the offset of the first FASTQ record to start after offset.
+
+  A record is recognized as a line starting with "@" whose second line after
+  it (skipping blank lines) starts with "+"; a quality line starting with "@"
+  is followed two lines later by a sequence, so it never qualifies.
+  """
+  handle.seek(offset)
+  handle.readline()
+  lines = collections.deque(maxlen=3)
+  while True:
+    position = handle.tell()
+    line = handle.readline()
+    if not line:
+      return position
+    if line.isspace():
+      continue
+    lines.append((position, line))
+    if (len(lines) == 3 and lines[0][1].startswith(b'@') and
+        lines[2][1].startswith(b'+')):
+      return lines[0][0]
+
+def fastq_ranges(filename, chunk_size=CHUNK_SIZE):
+  """Yield (start, end) byte ranges of about chunk_size records each.
+
+  filename must be uncompressed.  Every range but the first starts at a
+  record, so the ranges can be read and counted independently, in any order.
+  """
+  size = os.path.getsize(filename)
+  with open(filename, 'rb') as handle:
+    sample = list(itertools.islice(handle, 4 * SAMPLE_RECORDS))
+    record_bytes = 4 * sum(len(line) for line in sample) / max(len(sample), 1)
+    step = max(int(record_bytes * chunk_size), 1)
+    start = 0
+    while start < size:
+      end = size
+      if start + step < size:
+        end = _record_start(handle, start + step)
+      yield start, end
+      start = end
+
+def fastq_blocks(handle, chunk_size=CHUNK_SIZE):
+  """Yield raw FASTQ bytes from handle in blocks of about chunk_size records.
+
+  Every block but the first starts at a record (see _record_start), so the
+  blocks can be counted independently.  Unlike fastq_ranges, this works on a
+  stream, e.g. a gzipped file being decompressed.
+  """
+  step = None
+  pending = b''
+  while True:
+    data = handle.read(step or READ_BUFFER)
+    if not data:
+      break
+    pending += data
+    if step is None:
+      records = max(pending.count(b'\n') // 4, 1)
+      step = max(len(pending) * chunk_size // records, 1)
+    while len(pending) > step:
+      cut = _record_start(io.BytesIO(pending), step)
+      if cut == len(pending):
+        break  # no whole record starts after step yet; read more
+      yield pending[:cut]
+      pending = pending[cut:]
+  if pending:
+    yield pending
+
+def format_records(lines):
+  """Render flat record lines as FASTQ text, as SeqIO.write would."""
+  out = list()
+  for i in range(0, len(lines), 4):
+    out.extend((lines[i], lines[i+1], b'+', lines[i+3]))
+  out.append(b'')
+  return b'\n'.join(out)
+
+def record_lines(record):
+  """Flat FASTQ lines for a Bio.SeqIO fastq-sanger record."""
+  quals = record.letter_annotations['phred_quality']
+  return [b'@' + record.description.encode(), bytes(record.seq),
+          b'+', bytes(q + 33 for q in quals)]
+
+
+class SkipWriter(object):
+  """Streams skipped records to one FASTQ file per mate.
+
+  Text is buffered up to budget bytes per file before it is written, and is
+  gzip compressed if compress is set (a .gz suffix is then added).
+  """
+  def __init__(self, filenames, budget=SKIP_BUDGET, compress=False):
+    self.handles = list()
+    for filename in filenames:
+      if compress:
+        raw = gzip.open(str(filename) + '.gz', 'wb')
+      else:
+        raw = open(filename, 'wb', buffering=0)
+      self.handles.append(io.BufferedWriter(raw, buffer_size=budget))
+    self.skipped = 0
+
+  def add(self, *mates):
+    """Record skipped reads, given as flat FASTQ lines for each mate."""
+    self.skipped += len(mates[0]) // 4
+    for handle, lines in zip(self.handles, mates):
+      handle.write(format_records(lines))
+
+  def close(self):
+    for handle in self.handles:
+      handle.close()
+    logging.info('Skipped {0} reads'.format(self.skipped))
+
+
+class SkipSampler(SkipWriter):
+  """Like SkipWriter, but keeps only a uniform sample of size records.
+
+  Uses reservoir sampling, so memory is bounded by size no matter how many
+  reads are skipped.  The sample is written, in input order, on close().
+  """
+  def __init__(self, filenames, size, compress=False, seed=0):
+    super().__init__(filenames, compress=compress)
+    self.size = size
+    self.sample = list()
+    self.rng = random.Random(seed)
+
+  def add(self, *mates):
+    for i in range(0, len(mates[0]), 4):
+      records = [lines[i:i+4] for lines in mates]
+      if len(self.sample) < self.size:
+        self.sample.append((self.skipped, records))
+      else:
+        slot = self.rng.randrange(self.skipped + 1)
+        if slot < self.size:
+          self.sample[slot] = (self.skipped, records)
+      self.skipped += 1
+
+  def close(self):
+    for _, records in sorted(self.sample, key=lambda s: s[0]):
+      for handle, lines in zip(self.handles, records):
+        handle.write(format_records(lines))
+    kept = len(self.sample)
+    logging.info('Kept a sample of {kept} skipped reads'.format(**locals()))
+    super().close()
+
+
+def skip_output(filenames, *, budget=SKIP_BUDGET, compress=False, sample=0):
+  """Return a SkipSampler if sample > 0, otherwise a SkipWriter."""
+  if sample > 0:
+    return SkipSampler(filenames, sample, compress=compress)
+  return SkipWriter(filenames, budget=budget, compress=compress)
+
+def extract_spacer(seq, reverse=False):
+  """Return the guide spacer (in guide orientation) from seq, or None."""
+  if not reverse:
+    endpos = seq.find(FORWARD_TAIL)
+    if endpos < 0:
+      return None
+    return seq[:endpos]
+  startpos = seq.find(REVERSE_HEADER)
+  if startpos < 0:
+    return None
+  startpos += len(REVERSE_HEADER)
+  spacer = seq[startpos:startpos + SPACER_LEN]
+  return spacer.translate(_COMPLEMENT)[::-1]
+
+def count_chunk(lines, reverse=False):
+  """Return (Counter of spacers, lines of records lacking a spacer)."""
+  counts = collections.Counter()
+  skipped = list()
+  for i, seq in enumerate(lines[1::4]):
+    spacer = extract_spacer(seq, reverse)
+    if spacer is None:
+      skipped.extend(lines[4*i:4*i+4])
+    else:
+      counts[spacer] += 1
+  return counts, skipped
+
+def _anchor_hits(buf, anchor):
+  """Ascending offsets in the uint8 array buf at which the bytes anchor start.
+
+  Only offsets matching the first byte are checked against the next one, and
+  so on, so each extra anchor byte costs less than the last.
+  """
+  anchor = np.frombuffer(anchor, dtype=np.uint8)
+  hits = np.flatnonzero(buf[:max(len(buf) - len(anchor) + 1, 0)] == anchor[0])
+  for i in range(1, len(anchor)):
+    hits = hits[buf[hits + i] == anchor[i]]
+  return hits
+
+def count_block_batch(data, reverse=False):
+  """Same as count_block, finding and tallying spacers with numpy.
+
+  The whole block is searched for the anchor in one pass over its bytes,
+  without splitting it into lines, and spacers are tallied by np.unique.
+  Blocks with blank lines or trailing whitespace, which fastq_chunks cleans
+  up, are counted line by line instead.
+  """
+  if not data:
+    return collections.Counter(), list()
+  if not data.endswith(b'\n'):
+    data += b'\n'
+  buf = np.frombuffer(data, dtype=np.uint8)
+  ends = np.flatnonzero(buf == ord('\n'))
+  starts = np.concatenate([[0], ends[:-1] + 1])
+  # empty lines, or lines ending in whitespace, are left to fastq_chunks
+  if (ends == starts).any() or _SPACE_LUT[buf[ends[ends > 0] - 1]].any():
+    return count_block(data, reverse)
+  nreads = len(ends) // 4
+  if len(ends) % 4:
+    first = starts[4 * nreads]
+    line = data[first:ends[4 * nreads]]
+    raise ValueError('Truncated FASTQ record: {0}'.format(line))
+  if not (buf[starts[0::4]] == ord('@')).all():
+    raise ValueError('FASTQ record does not start with "@"')
+  anchor = reverse and REVERSE_HEADER or FORWARD_TAIL
+  hits = _anchor_hits(buf, anchor)
+  lines = np.searchsorted(ends, hits)
+  on_seq = (lines % 4 == 1)
+  hits, lines = hits[on_seq], lines[on_seq]
+  # hits ascend, so the first hit of each read is bytes.find's answer
+  reads = lines // 4
+  first = np.flatnonzero(np.diff(reads, prepend=-1))
+  reads, hits = reads[first], hits[first]
+  seq_starts = starts[1::4][reads]
+  seq_ends = ends[1::4][reads]
+  if not reverse:
+    lengths = hits - seq_starts
+    cols = np.arange(max(lengths.max(initial=0), 1))
+    gather = seq_starts[:, None] + cols
+    spacers = buf[np.minimum(gather, len(buf) - 1)]
+  else:
+    spacer_starts = hits + len(REVERSE_HEADER)
+    lengths = np.clip(seq_ends - spacer_starts, 0, SPACER_LEN)
+    # Gather each spacer back to front, then complement via lookup table.
+    cols = np.arange(SPACER_LEN)
+    gather = spacer_starts[:, None] + lengths[:, None] - 1 - cols
+    spacers = _COMPLEMENT_LUT[buf[np.clip(gather, 0, len(buf) - 1)]]
+  spacers[cols >= lengths[:, None]] = 0
+  spacers = np.ascontiguousarray(spacers)
+  spacers = spacers.view('S{0}'.format(spacers.shape[1])).ravel()
+  # null padding is dropped by numpy, so keys match extract_spacer output
+  keys, first, tally = np.unique(spacers, return_index=True,
+                                 return_counts=True)
+  order = np.argsort(first)
+  counts = collections.Counter(dict(zip(keys[order].tolist(),
+                                        tally[order].tolist())))
+  # split each run of consecutive skipped reads back into lines in one go
+  missed = np.ones(nreads + 2, dtype=np.int8)
+  missed[reads + 1] = 0
+  missed[[0, -1]] = 0
+  edges = np.flatnonzero(np.diff(missed))
+  skipped = list()
+  for first, last in zip(edges[0::2], edges[1::2]):
+    skipped.extend(data[starts[4 * first]:ends[4 * last - 1]].split(b'\n'))
+  return counts, skipped
+
+def count_block(data, reverse=False, batch=False, chunk_size=CHUNK_SIZE):
+  """count_chunk for a block of raw FASTQ bytes (see count_block_batch)."""
+  if batch:
+    return count_block_batch(data, reverse)
+  counts = collections.Counter()
+  skipped = list()
+  for lines in fastq_chunks(io.BytesIO(data), chunk_size):
+    chunk_counts, chunk_skipped = count_chunk(lines, reverse)
+    counts.update(chunk_counts)
+    skipped.extend(chunk_skipped)
+  return counts, skipped
+
+def count_range(span, reverse=False, batch=False, chunk_size=CHUNK_SIZE):
+  """count_block for a (filename, start, end) range of an uncompressed file.
+
+  The worker reads its own bytes, so only the span and the results cross
+  between processes.
+  """
+  filename, start, end = span
+  with open(filename, 'rb') as handle:
+    handle.seek(start)
+    data = handle.read(end - start)
+  return count_block(data, reverse, batch, chunk_size)
+
+def read_id(title):
+  """Return the record id (as Bio.SeqIO would parse it) from a title line."""
+  fields = title[1:].split(None, 1)
+  return fields and fields[0] or b''
+
+def extract_pair(front, rear):
+  """Return the (front, rear) spacers of a read pair, or None."""
+  f_endpos = front.find(FRONT_TAIL)
+  r_startpos = rear.find(REAR_HEADER)
+  r_endpos = rear.find(REAR_TAIL)
+  if f_endpos < 0 or r_startpos < 0 or r_endpos < 0:
+    return None
+  r_startpos += len(REAR_HEADER)
+  f = front[FRONT_START:f_endpos]
+  r = rear[r_startpos:r_endpos].translate(_COMPLEMENT)[::-1]
+  return f, r
+
+def count_pair_chunk(chunks):
+  """Return (Counter of spacer pairs, skipped front lines, skipped rear lines).
+
+  chunks is a (front_lines, rear_lines) pair of matching fastq_chunks output.
+  """
+  front_lines, rear_lines = chunks
+  counts = collections.Counter()
+  skipped_front = list()
+  skipped_rear = list()
+  titles = zip(front_lines[0::4], rear_lines[0::4])
+  for i, (front_title, rear_title) in enumerate(titles):
+    if read_id(front_title) != read_id(rear_title):
+      template = 'Mates out of step: {front_title} vs. {rear_title}'
+      raise ValueError(template.format(**locals()))
+    pair = extract_pair(front_lines[4*i+1], rear_lines[4*i+1])
+    if pair is None:
+      skipped_front.extend(front_lines[4*i:4*i+4])
+      skipped_rear.extend(rear_lines[4*i:4*i+4])
+    else:
+      counts[pair] += 1
+  return counts, skipped_front, skipped_rear
+
+def read_ahead(iterable, depth=4):
+  """Yield from iterable, consuming it in a background thread.
+
+  Gzip decompression releases the GIL, so a reader per mate file keeps both
+  files decompressing alongside the counting.
+  """
+  items = queue.Queue(maxsize=depth)
+  done = object()
+  def fill():
+    try:
+      for item in iterable:
+        items.put((item, None))
+    except Exception as e:
+      items.put((done, e))
+    else:
+      items.put((done, None))
+  threading.Thread(target=fill, daemon=True).start()
+  while True:
+    item, error = items.get()
+    if error is not None:
+      raise error
+    if item is done:
+      return
+    yield item
+
+def count_fastq(filename, keys, skips, *,
+                reverse=False, jobs=1, chunk_size=CHUNK_SIZE, batch=False):
+  """Count spacers in filename without building SeqRecords.
+
+  Records with no recognizable spacer are passed to skips (see skip_output).
+  Returns (counts, reads); counts is seeded with keys and otherwise in
+  first-seen order, exactly as the SeqIO loop in count_guides.py builds it.
+  With batch set, blocks are counted with numpy (see count_block_batch).
+
+  The work is split into blocks of about chunk_size reads, counted by jobs
+  processes.  Workers read their own byte ranges of an uncompressed file; a
+  gzipped file is decompressed by a thread here, which hands each worker a
+  raw block of bytes.
+  """
+  counts = collections.Counter()
+  for key in keys:
+    counts[key.encode()] = 0
+  reads = 0
+  if is_gzipped(filename):
+    counter = functools.partial(count_block, reverse=reverse, batch=batch,
+                                chunk_size=chunk_size)
+    with open_fastq(filename) as handle:
+      blocks = read_ahead(fastq_blocks(handle, chunk_size))
+      reads = _tally(pl.ordered_map(counter, blocks, jobs), counts, skips)
+  else:
+    counter = functools.partial(count_range, reverse=reverse, batch=batch,
+                                chunk_size=chunk_size)
+    spans = ((filename, start, end)
+             for start, end in fastq_ranges(filename, chunk_size))
+    reads = _tally(pl.ordered_map(counter, spans, jobs), counts, skips)
+  return {k.decode(): v for k, v in counts.items()}, reads
+
+def _tally(results, counts, skips):
+  """Add (counts, skipped) results into counts and skips; return reads."""
+  reads = 0
+  for chunk_counts, skipped in results:
+    counts.update(chunk_counts)
+    reads += sum(chunk_counts.values()) + len(skipped) // 4
+    if skipped:
+      skips.add(skipped)
+    logging.info('...counted {reads} reads'.format(**locals()))
+  return reads
+
+def count_fastq_pairs(front_file, rear_file, skips, *,
+                      jobs=1, chunk_size=CHUNK_SIZE):
+  """Count (front, rear) spacer pairs in two mate files read in lockstep.
+
+  Each mate file is read and decompressed by its own thread; paired chunks
+  are counted across jobs processes.  Skipped pairs are passed to skips (see
+  skip_output) as (front, rear).  Returns (counts, reads), with counts in
+  first-seen order as the SeqIO loop in count_guide_pairs_2021.py builds it.
+  """
+  counts = collections.Counter()
+  reads = 0
+  with open_fastq(front_file) as front, open_fastq(rear_file) as rear:
+    front_chunks = read_ahead(fastq_chunks(front, chunk_size))
+    rear_chunks = read_ahead(fastq_chunks(rear, chunk_size))
+    paired = zip(front_chunks, rear_chunks)
+    for chunk_counts, skipped_front, skipped_rear in pl.ordered_map(
+        count_pair_chunk, paired, jobs):
+      counts.update(chunk_counts)
+      reads += sum(chunk_counts.values()) + len(skipped_front) // 4
+      if skipped_front:
+        skips.add(skipped_front, skipped_rear)
+      logging.info('...counted {reads} read pairs'.format(**locals()))
+  counts = {(f.decode(), r.decode()): v for (f, r), v in counts.items()}
+  return counts, reads
+
+def build_neighbor_index(guides, bases='ACGTN'):
+  """Index every sequence one substitution away from a guide.
+
+  Returns (index, collisions).  index maps each neighbor of exactly one guide
+  to that guide; collisions maps neighbors shared by several guides to the set
+  of those guides.  Guides themselves are never indexed, so exact matches
+  always win.
+  """
+  guides = set(guides)
+  index = dict()
+  collisions = dict()
+  for guide in guides:
+    for neighbor in cl.single_variants(guide, bases):
+      if neighbor in guides:
+        continue
+      if neighbor in collisions:
+        collisions[neighbor].add(guide)
+      elif neighbor in index:
+        collisions[neighbor] = set([index.pop(neighbor), guide])
+      else:
+        index[neighbor] = guide
+  return index, collisions
+
+def assign_near_misses(counts, index, collisions):
+  """Fold counts of unique one-mismatch neighbors into their guides.
+
+  Returns (assigned, ambiguous): the merged counts, in the original order, and
+  a dict of spacers left unassigned because they neighbor several guides.
+  """
+  assigned = dict()
+  ambiguous = dict()
+  for spacer, n in counts.items():
+    guide = index.get(spacer, spacer)
+    assigned[guide] = assigned.get(guide, 0) + n
+    if spacer in collisions:
+      ambiguous[spacer] = n
+  return assigned, ambiguous
+
+def load_guide_index(guide_set):
+  """Return the guides in guide_set; a guide's position is its integer ID.
+
+  Blank lines and repeats of an earlier guide are dropped, so IDs count
+  distinct guides in order of first appearance, not lines.
+  """
+  guides = [x.strip() for x in open(guide_set, 'r')]
+  guides = pd.unique(pd.Series([x for x in guides if x], dtype=object))
+  return pd.Index(guides, name='variant')
+
+def dense_counts(counts, guides):
+  """Return counts for guides, in order, as a uint32 (or uint64) array."""
+  dense = np.array([counts.get(x, 0) for x in guides], dtype=np.uint64)
+  if dense.size == 0 or dense.max() <= np.iinfo(np.uint32).max:
+    dense = dense.astype(np.uint32)
+  return dense
+
+def load_dense_counts(filename, guides):
+  """Load a dense count array (memory-mapped) and check it matches guides."""
+  dense = np.load(filename, mmap_mode='r')
+  if dense.shape != (len(guides),):
+    template = '{filename} has {dense.shape} counts, expected {0} guides'
+    raise ValueError(template.format(len(guides), **locals()))
+  return dense
+
+def write_counts(counts, hitlist, outfile, weirdfile):
+  """Write counts (by descending count) split into expected/unexpected."""
+  for k, v in sorted(counts.items(), key=lambda k_v: k_v[1], reverse=True):
+    if k in hitlist:
+      outfile.write('\t'.join([k, str(v)]) + '\n')
+    else:
+      weirdfile.write('\t'.join([k, str(v)]) + '\n')
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import logging
+import sys
+
+import model_lib as ml
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+
+def main():
+  ml.export_linear_model()
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 # Author: John Hawkins (jsh) [really@gmail.com]
 
+import hashlib
 import logging
+import os
+import pathlib
 import sys
 
 import pandas as pd
 import numpy as np
-from Bio import SeqIO
 
 import choice_lib as cl
+import count_lib as ctl
+import model_lib as ml
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -16,46 +20,268 @@ logging.basicConfig(level=logging.INFO,
 NORM_SIZE = float(40 * 1000 * 1000)
 MIN_START_READS = 100
 PSEUDO = 1
+GENE_INDEX_DIR = ml.CACHEDIR / 'genes'
 
-def get_start_mask(startfile):
-  start = pd.read_csv(startfile, sep='\t', header=None,
+def read_counts(filename, guides=None):
+  """Read a count file as a Series of reads indexed by variant.
+
+  filename is either a two-column .counts TSV or, if it ends in .npy, a dense
+  count array aligned to guides (see count_lib.load_guide_index).
+  """
+  if str(filename).endswith('.npy'):
+    if guides is None:
+      template = 'Dense count file {filename} needs a guide index'
+      raise ValueError(template.format(**locals()))
+    dense = ctl.load_dense_counts(filename, guides)
+    return pd.Series(np.asarray(dense, dtype=np.int64), index=guides,
+                     name='reads')
+  reads = pd.read_csv(filename, sep='\t', header=None,
                       names=['variant','reads'], index_col='variant')
-  start_mask = start.reads > MIN_START_READS
+  return reads.reads
+
+def min_reads_mask(reads):
+  start_mask = reads > MIN_START_READS
   start_mask.name = 'start_mask'
   return start_mask
 
-def log_counts(filename):
-  reads = pd.read_csv(filename, sep='\t', header=None,
-                      names=['variant','reads'], index_col='variant')
-  norm = reads.reads * (NORM_SIZE / reads.reads.sum())
+def log_normalize(reads):
+  norm = reads * (NORM_SIZE / reads.sum())
   log = np.log2(norm.clip(PSEUDO))
   return log
 
+def get_start_mask(startfile, guides=None):
+  return min_reads_mask(read_counts(startfile, guides))
+
+def log_counts(filename, guides=None):
+  return log_normalize(read_counts(filename, guides))
+
 def get_controlset(controlfile):
   controlframe = pd.read_csv(controlfile, header=None, names=['variant'])
   return set(controlframe.variant)
 
-def compute_gamma(startfile, endfile, controlset, gt):
-  start_mask = get_start_mask(startfile)
-  start = log_counts(startfile)
-  end = log_counts(endfile)
-  diff = end - start
-  diff = diff.where(start_mask, np.nan)
-  center = diff.loc[diff.index.isin(controlset)].median()
-  gamma = (diff - center) / gt
-  gamma.name = 'gamma'
-  masked_gamma = gamma.where(start_mask)
-  columns = [masked_gamma, start_mask]
-  frame = pd.concat(columns, sort=True, axis='columns')
-  frame.index.name = 'variant'
-  return frame
-
-def annotate_variants(variants, targetfile, locifile, genbank):
-  annoframe = pd.DataFrame(index=variants)
+class CountCache(object):
+  """Callable read_counts that parses each count file only once."""
+  def __init__(self, guides=None):
+    self.guides = guides
+    self.reads = dict()
+
+  def __call__(self, filename):
+    key = pathlib.Path(filename).resolve()
+    if key not in self.reads:
+      self.reads[key] = read_counts(filename, self.guides)
+    return self.reads[key]
+
+def compute_gamma(startfile, endfile, controlset, gt, guides=None, read=None):
+  """Gamma for each variant; read (e.g. a CountCache) loads count files."""
+  gammas = ReplicateGammas([(None, startfile, endfile)], controlset, gt,
+                           guides=guides, read=read)
+  frame = gammas.stacked().drop('rep', axis='columns')
+  return frame.set_index('variant')
+
+class ReplicateGammas(object):
+  """Gammas for several replicates at once, as a variants x replicates matrix.
+
+  samples is a list of (rep, startfile, endfile).  Every count file is read
+  once (through read, e.g. a CountCache) and aligned to the sorted union of
+  the variants seen, so each step below is one array operation over all the
+  replicates:  gamma is NaN wherever a replicate's start count is missing or
+  not above MIN_START_READS, and present marks the variants seen in either of
+  a replicate's count files.
+  """
+
+  def __init__(self, samples, controlset, gt, guides=None, read=None):
+    if read is None:
+      read = lambda filename: read_counts(filename, guides)
+    self.reps = pd.Index([rep for rep, _, _ in samples])
+    files = list()
+    for _, startfile, endfile in samples:
+      for filename in (startfile, endfile):
+        if filename not in files:
+          files.append(filename)
+    reads = [read(filename) for filename in files]
+    variants = reads[0].index
+    for other in reads[1:]:
+      if not other.index.equals(variants):
+        variants = variants.union(other.index)
+    if not variants.is_monotonic_increasing:
+      variants = variants.sort_values()
+    self.variants = variants
+    counts = np.empty((len(variants), len(files)))
+    for i, column in enumerate(reads):
+      if not column.index.equals(variants):
+        column = column.reindex(variants)
+      counts[:, i] = column.values
+    # log-normalize each file on its own read total
+    norm = counts * (NORM_SIZE / np.nansum(counts, axis=0))
+    logs = np.log2(np.clip(norm, PSEUDO, None))
+    start = [files.index(startfile) for _, startfile, _ in samples]
+    end = [files.index(endfile) for _, _, endfile in samples]
+    self.start_missing = np.isnan(counts[:, start])
+    self.present = ~(self.start_missing & np.isnan(counts[:, end]))
+    self.start_mask = counts[:, start] > MIN_START_READS
+    diff = np.where(self.start_mask, logs[:, end] - logs[:, start], np.nan)
+    controls = np.asarray(variants.isin(controlset))
+    center = pd.DataFrame(diff[controls]).median().values
+    self.gamma = (diff - center) / gt
+
+  def stacked(self, annotation=None):
+    """Long frame of (variant, gamma, start_mask, rep), replicate by replicate.
+
+    annotation, a frame with a row per variant, adds its columns to each row.
+    """
+    rep_rows, rows = np.nonzero(self.present.T)
+    start_mask = pd.arrays.BooleanArray(self.start_mask[rows, rep_rows],
+                                        self.start_missing[rows, rep_rows])
+    frame = pd.DataFrame({'variant': self.variants.take(rows),
+                          'gamma': self.gamma[rows, rep_rows],
+                          'start_mask': start_mask,
+                          'rep': self.reps.take(rep_rows)})
+    if annotation is not None:
+      annotation = annotation.drop('variant', axis='columns', errors='ignore')
+      annotation = annotation.iloc[rows].reset_index(drop=True)
+      frame = pd.concat([frame, annotation], axis='columns')
+    return frame
+
+  def order(self):
+    """Variant positions in order of first appearance in stacked()."""
+    first = np.argmax(self.present, axis=1)
+    return np.argsort(first, kind='stable')
+
+  def summary(self, annotation=None):
+    """Frame of mean gamma, its variance and n over replicates, by variant.
+
+    Variants are in order of first appearance in stacked(); annotation, a
+    frame with a row per variant, adds its columns.
+    """
+    gamma = self.gamma[:, np.argsort(self.reps, kind='stable')]
+    measured = ~np.isnan(gamma)
+    n = measured.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      mean = np.where(measured, gamma, 0).sum(axis=1) / n
+      spread = np.where(measured, gamma - mean[:, None], 0)
+      var = (spread * spread).sum(axis=1) / (n - 1)
+    var[n < 2] = np.nan
+    order = self.order()
+    frame = pd.DataFrame({'gamma': mean[order], 'gamma_var': var[order],
+                          'gamma_n': n[order]},
+                         index=self.variants.take(order))
+    frame.index.name = 'variant'
+    if annotation is not None:
+      annotation = annotation.iloc[order].set_index(frame.index)
+      annotation = annotation.drop('variant', axis='columns', errors='ignore')
+      frame = pd.concat([annotation, frame], axis='columns')
+    return frame
+
+def _qualifier_value(text):
+  """Value of a /key="value" qualifier, unquoted as SeqIO would."""
+  text = text.strip()
+  if text.startswith('"'):
+    text = text[1:-1] if text.endswith('"') else text[1:]
+    text = text.replace('""', '"')
+  return text
+
+def read_gene_features(genbank):
+  """Map locus_tag -> gene name (or locus_tag) for the gene features of genbank.
+
+  Streams the FEATURES tables only, skipping sequence data; gene features
+  without a locus_tag are ignored.
+  """
+  locusgenemap = dict()
+  def finish(quals):
+    first = dict()
+    for key, value in quals or []:
+      first.setdefault(key, value)
+    if 'locus_tag' in first:
+      locus_tag = _qualifier_value(first['locus_tag'])
+      gene = locus_tag
+      if 'gene' in first:
+        gene = _qualifier_value(first['gene'])
+      locusgenemap[locus_tag] = gene
+  with open(genbank, 'r') as handle:
+    in_features = False
+    quals = None # [key, raw value] pairs of the current gene feature
+    for line in handle:
+      if not in_features:
+        in_features = line.startswith('FEATURES')
+      elif not line.startswith(' '):
+        # ORIGIN (or CONTIG, //, ...) ends the table; resume at the next record
+        finish(quals)
+        quals = None
+        in_features = False
+      elif line[5:6].strip():
+        finish(quals)
+        quals = list() if line[5:21].split()[0] == 'gene' else None
+      elif quals is not None:
+        text = line[21:].strip()
+        if text.startswith('/'):
+          key, _, value = text[1:].partition('=')
+          quals.append([key, value])
+        elif quals:
+          quals[-1][1] += ' ' + text
+    finish(quals)
+  return locusgenemap
+
+def gene_index(genbank, indexdir=GENE_INDEX_DIR):
+  """locus_tag -> gene map for genbank, cached in indexdir.
+
+  The cached index is keyed by a hash of the file's path, size and mtime, so
+  it is rebuilt whenever the file changes.
+  """
+  genbank = pathlib.Path(genbank).resolve()
+  stat = genbank.stat()
+  key = '{0}\0{1.st_size}\0{1.st_mtime_ns}'.format(genbank, stat)
+  digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+  indexfile = pathlib.Path(indexdir) / '{0}.{1}.npz'.format(genbank.name, digest)
+  if indexfile.exists():
+    with np.load(indexfile) as index:
+      return dict(zip(index['locus_tag'].tolist(), index['gene'].tolist()))
+  logging.info('Indexing genes in {genbank}...'.format(**locals()))
+  locusgenemap = read_gene_features(genbank)
+  try:
+    indexfile.parent.mkdir(parents=True, exist_ok=True)
+    partial = indexfile.with_suffix('.{0}.tmp'.format(os.getpid()))
+    with open(partial, 'wb') as handle:
+      np.savez_compressed(handle,
+                          locus_tag=np.array(list(locusgenemap), dtype=str),
+                          gene=np.array(list(locusgenemap.values()), dtype=str))
+    os.replace(partial, indexfile)
+  except OSError as e:
+    logging.warn('Could not cache gene index {indexfile}: {e}'.format(**locals()))
+  return locusgenemap
+
+def variant_space(targetfile, locifile):
+  """Every single-mismatch pair for the loci, in variant index form.
+
+  Includes a self-pair for each target, as cl.parent_pairs; y_pred is unset.
+  """
   loci = set(pd.read_csv(locifile, sep='\t', header=None)[0])
   targetframe = pd.read_csv(targetfile, sep='\t')
   filtered = cl.filter_targets(targetframe, loci)
-  variantspace = cl.build_pairs(filtered, loci)
+  pairs = cl.build_pairs(filtered, loci)
+  pairs['original'] = pairs.original.astype(object)
+  pairs['y_pred'] = np.nan
+  return pd.concat([cl.parent_pairs(filtered), pairs[cl.INDEX_COLUMNS]],
+                   ignore_index=True)
+
+def annotate_variants(variants, targetfile, locifile, genbank, index=None):
+  """Attach original, locus_tag and gene to each of variants.
+
+  If index (a variant index saved by choose_guides.py, see
+  cl.load_variant_index) is given, pairs are looked up in it rather than
+  regenerated from targetfile and locifile.  Variants found in neither are
+  their own original, with no locus_tag or gene.
+  """
+  annoframe = pd.DataFrame(index=variants)
+  if index is None:
+    loci = set(pd.read_csv(locifile, sep='\t', header=None)[0])
+    targetframe = pd.read_csv(targetfile, sep='\t')
+    filtered = cl.filter_targets(targetframe, loci)
+    variantspace = cl.build_pairs(filtered, loci)
+    origlocusmap = filtered[['target', 'locus_tag']]
+  else:
+    parent_mask = index.variant == index.original
+    variantspace = index.loc[~parent_mask]
+    origlocusmap = index.loc[parent_mask, ['original', 'locus_tag']]
   relevant = variantspace.loc[variantspace.variant.isin(variants) &
                               variantspace.original.isin(variants)]
   relevant = relevant[['variant', 'original']]
@@ -63,19 +289,9 @@ def annotate_variants(variants, targetfile, locifile, genbank):
                        left_index=True, right_on='variant', how='left')
   unset_mask = annoframe.original.isna()
   annoframe.original = annoframe.variant.where(unset_mask, annoframe.original)
-  origlocusmap = filtered[['target', 'locus_tag']]
   origlocusmap.columns = ['original', 'locus_tag']
   annoframe = pd.merge(annoframe, origlocusmap, on='original', how='left')
-  locusgenemap = dict()
-  gbhandle = open(genbank, 'r')
-  for record in SeqIO.parse(gbhandle, 'genbank'):
-    for feature in record.features:
-      if feature.type == 'gene':
-        quals = feature.qualifiers
-        if 'gene' in quals:
-          locusgenemap[quals['locus_tag'][0]] = quals['gene'][0]
-        else:
-          locusgenemap[quals['locus_tag'][0]] = quals['locus_tag'][0]
+  locusgenemap = gene_index(genbank)
   locusgenemap = pd.DataFrame.from_dict(locusgenemap, orient='index')
   locusgenemap = locusgenemap.reset_index()
   locusgenemap.columns = ['locus_tag', 'gene']
@@ -6,9 +6,11 @@ import logging
 import pathlib
 import sys
 
+import numpy as np
 import pandas as pd
 
 import gamma_lib as gl
+import io_lib as iol
 import model_lib as ml
 
 logging.basicConfig(level=logging.INFO,
@@ -30,17 +32,24 @@ def parse_args():
       '--relfitfile', type=str,
       help='file: destination for relfit scores',
       required=True)
+  parser.add_argument(
+      '--chunk_rows', type=int,
+      help='int: # of rows to convert at a time',
+      default=iol.CHUNK_ROWS)
   args = parser.parse_args()
   return args
 
 
 def main():
   args = parse_args()
-  gammaframe = pd.read_csv(args.gammafile, sep='\t')
-  relfitframe = gammaframe.copy(deep=True)
-  relfitframe.gamma = relfitframe.gamma + 1
-  relfitframe.rename({'gamma':'relfit'}, axis='columns', inplace=True)
-  relfitframe.to_csv(args.relfitfile, sep='\t', index=False)
+  # TSV to TSV passes every other column through as text
+  text = not iol.is_columnar(args.relfitfile)
+  with iol.TableWriter(args.relfitfile) as writer:
+    for chunk in iol.read_chunks(args.gammafile, args.chunk_rows, text=text):
+      gamma = pd.to_numeric(chunk.gamma.replace('', np.nan))
+      chunk = chunk.rename({'gamma':'relfit'}, axis='columns')
+      chunk['relfit'] = gamma + 1
+      writer.write(chunk)
 
 ##############################################
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import logging
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+
+try:
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = None
+  pq = None
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+COLUMNAR_SUFFIXES = ['.parquet', '.pq']
+# repeated strings, stored dictionary-encoded and read back as categoricals
+CATEGORICAL = ['variant', 'original', 'locus_tag', 'gene', 'pam', 'rep',
+               'chrom', 'transdir', 'repldir']
+# scores that do not need more than float32 precision
+FLOAT32 = ['y_pred', 'knockdown', 'gamma', 'relfit', 'gamma_var']
+CHUNK_ROWS = 1 << 18
+
+def is_columnar(filename):
+  """True if filename should be read/written as Parquet rather than TSV."""
+  return pathlib.Path(filename).suffix.lower() in COLUMNAR_SUFFIXES
+
+def _require_pyarrow(filename):
+  if pq is None:
+    template = 'Reading or writing {filename} requires pyarrow'
+    logging.fatal(template.format(**locals()))
+    sys.exit(2)
+
+def compact(frame):
+  """frame with CATEGORICAL strings as categoricals and FLOAT32 as float32."""
+  frame = frame.copy(deep=False)
+  for column in frame.columns:
+    values = frame[column]
+    if column in CATEGORICAL and (pd.api.types.is_object_dtype(values) or
+                                  pd.api.types.is_string_dtype(values)):
+      frame[column] = values.astype('category')
+    elif column in FLOAT32 and pd.api.types.is_float_dtype(values):
+      frame[column] = values.astype(np.float32)
+  return frame
+
+def _arrow_table(frame):
+  table = pa.Table.from_pandas(compact(frame), preserve_index=False)
+  # fix the dictionary index width so that chunks share one schema
+  fields = list()
+  for field in table.schema:
+    if pa.types.is_dictionary(field.type):
+      field = field.with_type(pa.dictionary(pa.int32(), field.type.value_type))
+    fields.append(field)
+  return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+def _untyped(arrow_type):
+  if pa.types.is_dictionary(arrow_type):
+    arrow_type = arrow_type.value_type
+  return pa.types.is_null(arrow_type)
+
+def read_table(filename, columns=None):
+  """Read a TSV, or a Parquet file (with categoricals) by suffix."""
+  if is_columnar(filename):
+    _require_pyarrow(filename)
+    return pq.read_table(filename, columns=columns).to_pandas()
+  return pd.read_csv(filename, sep='\t', usecols=columns)
+
+def read_chunks(filename, rows=CHUNK_ROWS, text=False):
+  """Yield the rows of a table file as frames of up to rows rows.
+
+  With text set, TSV columns are left as the strings that were read (empty
+  for missing values), so that they can be written back out unchanged.
+  Otherwise they are parsed with nullable dtypes, so that a column keeps one
+  type in every chunk whether or not the chunk has missing values.
+  """
+  if is_columnar(filename):
+    _require_pyarrow(filename)
+    for batch in pq.ParquetFile(filename).iter_batches(batch_size=rows):
+      yield pa.Table.from_batches([batch]).to_pandas()
+    return
+  if text:
+    options = dict(dtype=str, keep_default_na=False)
+  else:
+    options = dict(dtype_backend='numpy_nullable')
+  for chunk in pd.read_csv(filename, sep='\t', chunksize=rows, **options):
+    yield chunk
+
+def write_table(frame, filename, index=False):
+  """Write frame as a TSV, or a compact Parquet file, by suffix."""
+  with TableWriter(filename, index=index) as writer:
+    writer.write(frame)
+
+class TableWriter(object):
+  """Append frames, in order, to one TSV or Parquet file (by suffix).
+
+  A Parquet file's schema is fixed by the first frame in which no column is
+  untyped (e.g. empty, or all missing); frames before it are held until then.
+  """
+
+  def __init__(self, filename, index=False):
+    self.filename = filename
+    self.index = index
+    self._columnar = is_columnar(filename)
+    self._writer = None
+    self._pending = list()
+    self._handle = None
+    if self._columnar:
+      _require_pyarrow(filename)
+    else:
+      self._handle = open(filename, 'w')
+
+  def write(self, frame):
+    if self.index:
+      frame = frame.reset_index()
+    if not self._columnar:
+      frame.to_csv(self._handle, sep='\t', index=False,
+                   header=self._handle.tell() == 0)
+      return
+    table = _arrow_table(frame)
+    if self._writer is not None:
+      self._writer.write_table(table.cast(self._writer.schema))
+      return
+    self._pending.append(table)
+    if not any(_untyped(field.type) for field in table.schema):
+      self._open(table.schema)
+
+  def _open(self, schema):
+    self._writer = pq.ParquetWriter(self.filename, schema)
+    for table in self._pending:
+      if table.num_rows:
+        self._writer.write_table(table.cast(schema))
+    self._pending = list()
+
+  def close(self):
+    if self._writer is None and self._pending:
+      # never saw every column typed; settle for what there is
+      schemas = [table.schema for table in self._pending]
+      self._open(pa.unify_schemas(schemas, promote_options='permissive'))
+    if self._writer is not None:
+      self._writer.close()
+    if self._handle is not None:
+      self._handle.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
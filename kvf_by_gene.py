@@ -2,7 +2,9 @@
 # Author: John Hawkins (jsh) [really@gmail.com]
 
 import argparse
+import hashlib
 import logging
+import os
 import pandas as pd
 import pathlib
 import shutil
@@ -13,11 +15,16 @@ import numpy as np
 import scipy.stats as st
 import seaborn as sns
 
+import io_lib as iol
+import metrics_lib as mtl
+import parallel_lib as pl
+
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s') 
 
 _PACKAGEDIR = pathlib.Path(__file__).parent
 TESTDIR = _PACKAGEDIR / 'testdata'
+MANIFEST = 'kvf.manifest.tsv'
 
 
 def parse_args():
@@ -31,14 +38,33 @@ def parse_args():
       default=str(TESTDIR / 'relfit.mean.tsv'))
   parser.add_argument(
       '--plotdir', type=str,
-      help='directory: directory for plots (WARNING: will be created and cleared)',
+      help='directory: directory for plots (WARNING: will be created and '
+           'cleared, unless --incremental)',
       default=str(TESTDIR / 'kvf.plots'))
+  parser.add_argument(
+      '--incremental', action='store_true',
+      help='Keep PLOTDIR and only redraw plots whose data has changed.')
+  parser.add_argument(
+      '--jobs', type=int,
+      help='int: number of worker processes for drawing plots',
+      default=1)
+  parser.add_argument(
+      '--statsfile', type=str,
+      help='file: write per-gene correlation statistics here (TSV)',
+      default=None)
+  parser.add_argument(
+      '--skip_plots', action='store_true',
+      help='Do not draw any plots (e.g. with --statsfile for a quick summary).')
+  mtl.add_metrics_args(parser)
   args = parser.parse_args()
   return args
 
 
+def plottable(data):
+  return data.dropna(subset=['knockdown', 'relfit'])
+
 def plot_kvf(data, name, plotfile, *, color=True):
-  data = data.dropna(subset=['knockdown', 'relfit'])
+  data = plottable(data)
   if len(data) < 1:
     logging.warn('No data to plot for {name}'.format(**locals()))
     return
@@ -48,7 +74,10 @@ def plot_kvf(data, name, plotfile, *, color=True):
     prs = np.nan
   figure = plt.figure(figsize=(6,6))
   hue = (color and 'original' or None)
-  plot = sns.scatterplot('knockdown', 'relfit', data=data, hue=hue,
+  if color:
+    # only this plot's families (original may be a library-wide categorical)
+    data = data.assign(original=data.original.astype(str))
+  plot = sns.scatterplot(x='knockdown', y='relfit', data=data, hue=hue,
                          s=10, alpha=1, edgecolor='none', legend=False)
   plt.text(0, -0.1, 'Pearson R: {prs:.2f}'.format(**locals()))
   plt.title('{name}\nKnockdown vs. Relative Fitness'.format(**vars()))
@@ -60,22 +89,153 @@ def plot_kvf(data, name, plotfile, *, color=True):
   plt.savefig(plotfile, dpi=600)
   plt.close('all')
 
-def main():
-  args = parse_args()
-  # reset PLOTDIR
-  data = pd.read_csv(args.meanrelfit, sep='\t')
-  data.set_index('variant', inplace=True)
-  data['knockdown'] = data['y_pred']
+def grouped_fit(data, keys, x, y):
+  """Per-group n, Pearson R, slope and intercept of y on x, in one pass.
+
+  keys are columns of data; rows missing x or y are ignored.
+  """
+  data = data.dropna(subset=[x, y])
+  frame = pd.DataFrame({'x': data[x].values.astype(float),
+                        'y': data[y].values.astype(float)})
+  frame['xx'] = frame.x * frame.x
+  frame['yy'] = frame.y * frame.y
+  frame['xy'] = frame.x * frame.y
+  groups = [data[k].values for k in keys]
+  sums = frame.groupby(groups, sort=True, observed=True).sum()
+  n = frame.groupby(groups, sort=True, observed=True).size()
+  sums.index.names = keys
+  n.index.names = keys
+  with np.errstate(divide='ignore', invalid='ignore'):
+    sxx = sums.xx - sums.x * sums.x / n
+    syy = sums.yy - sums.y * sums.y / n
+    sxy = sums.xy - sums.x * sums.y / n
+    # one point, or no spread in x or y, gives no correlation
+    sxx = sxx.where(sxx > 1e-12 * sums.xx.abs())
+    syy = syy.where(syy > 1e-12 * sums.yy.abs())
+    stats = pd.DataFrame({'n': n})
+    stats['pearson'] = (sxy / np.sqrt(sxx * syy)).clip(-1, 1)
+    stats['slope'] = sxy / sxx
+    stats['intercept'] = (sums.y - stats.slope * sums.x) / n
+  return stats
+
+def gene_stats(data):
+  """Table of knockdown vs. fitness defect (1-relfit) statistics per gene.
+
+  The first row, OVERALL, covers every gene.  Spearman's rho is Pearson's R
+  of within-gene ranks; family columns summarize the same fit made within
+  each original (parent) guide.
+  """
+  data = plottable(data)[['gene', 'original', 'knockdown', 'relfit']].copy()
+  data['defect'] = 1 - data.relfit
+  overall = data.assign(gene='OVERALL')
+  data = pd.concat([overall, data], ignore_index=True)
+  stats = grouped_fit(data, ['gene'], 'knockdown', 'defect')
+  for column in ('knockdown', 'defect'):
+    data[column + '_rank'] = data.groupby('gene', observed=True)[column].rank()
+  ranks = grouped_fit(data, ['gene'], 'knockdown_rank', 'defect_rank')
+  stats['spearman'] = ranks.pearson.clip(-1, 1)
+  by_gene = data.groupby('gene', observed=True).relfit
+  stats['mean_relfit'] = by_gene.mean()
+  stats['median_relfit'] = by_gene.median()
+  stats['min_relfit'] = by_gene.min()
+  families = grouped_fit(data, ['gene', 'original'], 'knockdown', 'defect')
+  by_family = families.groupby(level='gene')
+  stats['n_families'] = by_family.size()
+  stats['median_family_size'] = by_family.n.median()
+  stats['mean_family_pearson'] = by_family.pearson.mean()
+  stats['mean_family_slope'] = by_family.slope.mean()
+  columns = ['n', 'n_families', 'median_family_size', 'pearson', 'spearman',
+             'slope', 'intercept', 'mean_relfit', 'median_relfit',
+             'min_relfit', 'mean_family_pearson', 'mean_family_slope']
+  stats = stats[columns]
+  order = ['OVERALL'] + sorted(g for g in stats.index if g != 'OVERALL')
+  return stats.reindex(order)
+
+def plot_jobs(data, plotdir):
+  """Yield (data, name, plotfile, color) for the overall and per-gene plots."""
+  plotfile = plotdir / '.'.join(['kvf', 'overall', 'png'])
+  yield data, 'OVERALL', plotfile, False
+  for gene, group in data.groupby('gene', observed=True):
+    plotfile = plotdir / '.'.join(['kvf', gene, 'png'])
+    yield group, gene, plotfile, True
+
+def content_hash(data, color):
+  """Hash of everything plot_kvf draws from data."""
+  digest = hashlib.sha1(str(color).encode())
+  columns = plottable(data)[['knockdown', 'relfit', 'original']]
+  digest.update(pd.util.hash_pandas_object(columns).values.tobytes())
+  return digest.hexdigest()
+
+def read_manifest(plotdir):
+  manifest = plotdir / MANIFEST
+  if not manifest.exists():
+    return dict()
+  frame = pd.read_csv(manifest, sep='\t', header=None, names=['plot', 'hash'])
+  return dict(zip(frame['plot'], frame['hash']))
+
+def write_manifest(plotdir, hashes):
+  manifest = plotdir / MANIFEST
+  partial = manifest.with_suffix('.tmp')
+  with open(partial, 'w') as handle:
+    for plot, digest in sorted(hashes.items()):
+      handle.write('\t'.join([plot, digest]) + '\n')
+  os.replace(partial, manifest)
+
+def _plot_job(job):
+  data, name, plotfile, color = job
+  plot_kvf(data, name, plotfile, color=color)
+
+def draw_plots(args, data, metrics):
   plotdir = pathlib.Path(args.plotdir)
-  shutil.rmtree(plotdir, ignore_errors=True)
+  if not args.incremental:
+    # reset PLOTDIR
+    shutil.rmtree(plotdir, ignore_errors=True)
   plotdir.mkdir(parents=True, exist_ok=True)
-  # draw gene-by-gene scatterplots
+  previous = read_manifest(plotdir)
+  # draw gene-by-gene scatterplots, skipping those whose data is unchanged
   logging.info('Drawing plots...')
-  plotfile = plotdir / '.'.join(['kvf', 'overall', 'png'])
-  plot_kvf(data, 'OVERALL', plotfile, color=False)
-  for gene, group in data.groupby('gene'):
-    plotfile = plotdir / '.'.join(['kvf', gene, 'png'])
-    plot_kvf(group, gene, plotfile)
+  with metrics.stage('plot'):
+    hashes = dict()
+    jobs = list()
+    for job in plot_jobs(data, plotdir):
+      group, name, plotfile, color = job
+      digest = content_hash(group, color)
+      hashes[plotfile.name] = digest
+      if previous.get(plotfile.name) != digest:
+        jobs.append(job)
+      elif not plotfile.exists() and len(plottable(group)):
+        jobs.append(job)
+    total = len(hashes)
+    skipped = total - len(jobs)
+    template = '...{skipped}/{total} plots unchanged, drawing the rest'
+    logging.info(template.format(**locals()))
+    metrics.count('skipped', skipped)
+    for stale in set(previous) - set(hashes):
+      (plotdir / stale).unlink(missing_ok=True)
+    for _ in pl.ordered_map(_plot_job, jobs, args.jobs):
+      metrics.count('plots', stage='plot')
+    write_manifest(plotdir, hashes)
+
+def main():
+  args = parse_args()
+  metrics = mtl.Metrics('kvf_by_gene', args.profile)
+  with metrics.stage('read'):
+    data = iol.read_table(args.meanrelfit)
+    data.set_index('variant', inplace=True)
+    data['knockdown'] = data['y_pred']
+  if args.statsfile is not None:
+    logging.info('Computing per-gene statistics...')
+    with metrics.stage('stats'):
+      stats = gene_stats(data)
+      stats.index.name = 'gene'
+      if iol.is_columnar(args.statsfile):
+        iol.write_table(stats, args.statsfile, index=True)
+      else:
+        stats.to_csv(args.statsfile, sep='\t', float_format='%.6g')
+    metrics.count('genes', len(stats) - 1, stage='stats')
+  if not args.skip_plots:
+    draw_plots(args, data, metrics)
+  metrics.finish(args.metrics)
 
 ##############################################
 if __name__ == "__main__":
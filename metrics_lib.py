@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import collections
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+STATM = '/proc/self/statm'
+SAMPLE_SECONDS = 0.05
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+  """High-water resident set size in MB (of this process, by default)."""
+  return resource.getrusage(who).ru_maxrss / 1024.0
+
+def rss_mb():
+  """Current resident set size in MB, or None if /proc is not available."""
+  try:
+    with open(STATM) as handle:
+      pages = int(handle.read().split()[1])
+  except (OSError, IndexError, ValueError):
+    return None
+  return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+
+class RSSSampler(object):
+  """Track the peak of rss_mb() between start() and stop().
+
+  A daemon thread polls every interval seconds, so spikes shorter than that
+  can be missed.  Where rss_mb() is unavailable, stop() falls back to the
+  process-lifetime high-water mark from peak_rss_mb().
+  """
+
+  def __init__(self, interval=SAMPLE_SECONDS):
+    self.interval = interval
+    self.peak = None
+    self._done = threading.Event()
+    self._thread = None
+
+  def _sample(self):
+    rss = rss_mb()
+    if rss is not None:
+      self.peak = max(self.peak or 0.0, rss)
+    return rss
+
+  def _poll(self):
+    while not self._done.wait(self.interval):
+      self._sample()
+
+  def start(self):
+    if self._sample() is not None:
+      self._thread = threading.Thread(target=self._poll, daemon=True)
+      self._thread.start()
+    return self
+
+  def stop(self):
+    self._done.set()
+    if self._thread is not None:
+      self._thread.join()
+    if self._sample() is None:
+      return peak_rss_mb()
+    return self.peak
+
+def add_metrics_args(parser):
+  """Add the --metrics and --profile options shared by the scripts."""
+  parser.add_argument(
+      '--metrics', type=str,
+      help='file: write stage timings, counters and peak memory here as JSON',
+      default=None)
+  parser.add_argument(
+      '--profile', type=str,
+      help='file: run under cProfile and dump the stats here',
+      default=None)
+
+class Metrics(object):
+  """Stage timers, counters and memory high-water marks for one run.
+
+  Use stage() as a context manager (or timed() as a decorator) around each
+  phase of work, and count() to attribute items to a stage, from which a rate
+  is derived.  Each stage's peak_rss_mb is the highest RSS sampled while it
+  ran; the summary's peak_rss_mb is the high-water mark of the whole run.  If
+  profile names a file, the run is profiled with cProfile from construction
+  until finish().
+  """
+
+  def __init__(self, name='', profile=None):
+    self.name = name
+    self.stages = collections.OrderedDict()
+    self.counters = collections.OrderedDict()
+    self.started = time.time()
+    self._start = time.perf_counter()
+    self._profile = profile
+    self._profiler = None
+    if profile is not None:
+      self._profiler = cProfile.Profile()
+      self._profiler.enable()
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    record = self.stages.setdefault(
+        name, dict(seconds=0.0, calls=0, peak_rss_mb=0.0))
+    sampler = RSSSampler().start()
+    start = time.perf_counter()
+    try:
+      yield record
+    finally:
+      seconds = time.perf_counter() - start
+      record['seconds'] += seconds
+      record['calls'] += 1
+      record['peak_rss_mb'] = max(record['peak_rss_mb'], sampler.stop())
+      template = '...{name} took {seconds:.3f}s'
+      logging.debug(template.format(**locals()))
+
+  def timed(self, name):
+    """Decorator form of stage()."""
+    def decorator(fn):
+      @functools.wraps(fn)
+      def wrapper(*args, **kwargs):
+        with self.stage(name):
+          return fn(*args, **kwargs)
+      return wrapper
+    return decorator
+
+  def count(self, name, n=1, stage=None):
+    """Add n to counter name; if stage is given, also report name per second."""
+    counter = self.counters.setdefault(name, dict(count=0, stage=stage))
+    counter['count'] += int(n)
+    if stage is not None:
+      counter['stage'] = stage
+
+  def merge(self, other):
+    """Add the stages and counters of other (e.g. from a worker) to these."""
+    for name, record in other.stages.items():
+      mine = self.stages.setdefault(
+          name, dict(seconds=0.0, calls=0, peak_rss_mb=0.0))
+      mine['seconds'] += record['seconds']
+      mine['calls'] += record['calls']
+      mine['peak_rss_mb'] = max(mine['peak_rss_mb'], record['peak_rss_mb'])
+    for name, counter in other.counters.items():
+      self.count(name, counter['count'], counter['stage'])
+
+  def seconds(self, name):
+    return self.stages[name]['seconds'] if name in self.stages else 0.0
+
+  def summary(self):
+    rates = collections.OrderedDict()
+    for name, counter in self.counters.items():
+      seconds = self.seconds(counter['stage'])
+      if seconds > 0:
+        rates[name + '_per_sec'] = counter['count'] / seconds
+    return collections.OrderedDict([
+        ('script', self.name),
+        ('argv', sys.argv),
+        ('started', self.started),
+        ('wall_seconds', time.perf_counter() - self._start),
+        ('peak_rss_mb', peak_rss_mb()),
+        ('children_peak_rss_mb', peak_rss_mb(resource.RUSAGE_CHILDREN)),
+        ('stages', self.stages),
+        ('counters', collections.OrderedDict(
+            (k, v['count']) for k, v in self.counters.items())),
+        ('rates', rates),
+    ])
+
+  def finish(self, filename=None):
+    """Stop profiling, log the stage breakdown, and write JSON to filename."""
+    if self._profiler is not None:
+      self._profiler.disable()
+      self._profiler.dump_stats(self._profile)
+      self._profiler = None
+    summary = self.summary()
+    for name, record in self.stages.items():
+      seconds = record['seconds']
+      template = 'Stage {name}: {seconds:.3f}s'
+      logging.info(template.format(**locals()))
+    for name, rate in summary['rates'].items():
+      template = '{name}: {rate:.1f}'
+      logging.info(template.format(**locals()))
+    if filename is not None:
+      with open(filename, 'w') as handle:
+        json.dump(summary, handle, indent=2)
+    return summary
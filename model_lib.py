@@ -1,21 +1,23 @@
 #!/usr/bin/env python
 # Author: John Hawkins (jsh) [really@gmail.com]
 
+import functools
+import hashlib
 import itertools
 import joblib
 import logging
+import os
 import os.path
 import pathlib
 import random
 import shutil
 import sys
+import time
+import zipfile
 
 import numpy as np
 import pandas as pd
-from pandas.api.types import CategoricalDtype
 from sklearn import preprocessing as skpreproc
-from keras.layers import Dense
-from keras.models import Sequential
 
 
 logging.basicConfig(level=logging.INFO,
@@ -29,52 +31,105 @@ MODELDIR = _CODEDIR / 'model'
 MODELFILE = MODELDIR / 'model.d5'.format(**locals())
 XS_FILE = MODELDIR / 'xscaler.dump'
 YS_FILE = MODELDIR / 'yscaler.dump'
+LINEAR_FILE = MODELDIR / 'linear.npz'
+
+CACHEDIR = pathlib.Path(os.environ.get('MISMATCH_CRISPRI_CACHE',
+                                       '~/.cache/mismatch_crispri'))
+CACHEDIR = CACHEDIR.expanduser()
+PREDICTION_CACHE = CACHEDIR / 'predictions'
+CACHE_MAX_ROWS = 50 * 1000 * 1000
+CACHE_MAX_SHARDS = 16
+# other models' predictions are dropped once unused this long (seconds), or
+# oldest-used first while the whole cache is over CACHE_MAX_BYTES
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+CACHE_MAX_BYTES = 8 << 30
 
 _EPOCHS = 30
 _BATCH_SIZE = 32
 
 def _build_linear_model(num_features):
+  # Imported here so that prediction never has to load keras/tensorflow.
+  from keras.layers import Dense
+  from keras.models import Sequential
   model = Sequential()
   model.add(Dense(1, input_dim=num_features, activation='linear'))
   model.compile(loss='mse', metrics=['mse'], optimizer='adam')
   return model
 
-def _expand_dummies(frame):
-  categories = dict()
-  bases = ['A', 'C', 'G', 'T']
-  idxs = [x for x in range(20)]  # Magic number because guidelen is fixed.
-  pairs = [''.join(pair) for pair in itertools.product(bases, bases)]
-  categories['mm_idx'] = idxs
-  categories['mm_trans'] = pairs
-  widecols = list()
-  for column in frame.columns:
-    if column not in categories:
-      continue
-    frame[column] = frame[column].astype(CategoricalDtype(categories[column]))
-  return pd.get_dummies(frame)
-
-def _get_linear_encoder():
-  def encoder(inrow):
-    vari = inrow.variant
-    orig = inrow.original
-    mm_idx = None
-    for i in range(len(vari)):
-      if vari[i] != orig[i]:
-        if orig != vari[:i] + orig[i] + vari[i+1:]:
-          template = 'too many mismatches in pair {vari} <- {orig}'
-          raise ValueError(template.format(**locals()))
-        mm_idx = i
-    if mm_idx == None:
-      template = 'no mismatch in pair {vari} <- {orig}'
+_BASES = 'ACGT'
+_GUIDELEN = 20  # Magic number because guidelen is fixed.
+_TRANSITIONS = [''.join(pair) for pair in itertools.product(_BASES, _BASES)]
+# Bases outside ACGT all get the extra code len(_BASES).
+_BASE_CODES = np.full(256, len(_BASES), dtype=int)
+_BASE_CODES[np.frombuffer(_BASES.encode(), dtype=np.uint8)] = range(len(_BASES))
+
+def _as_base_matrix(seqs):
+  """View a sequence of equal-length strings as an (n x len) uint8 matrix."""
+  arr = np.array(list(seqs), dtype=bytes)
+  return arr.view(np.uint8).reshape(len(arr), arr.dtype.itemsize)
+
+def _mismatch_matrix(variants, originals):
+  """Return (vari, orig, diff) uint8/bool matrices for paired sequences.
+
+  Shorter sequences are padded with zeros; positions past the end of a variant
+  never count as differences.
+  """
+  vari = _as_base_matrix(variants)
+  orig = _as_base_matrix(originals)
+  width = max(vari.shape[1], orig.shape[1])
+  if vari.shape[1] != orig.shape[1]:
+    vari, orig = [np.pad(m, ((0, 0), (0, width - m.shape[1]))) for m in (vari, orig)]
+  diff = (vari != orig) & (vari != 0)
+  return vari, orig, diff
+
+def count_mismatches(variants, originals):
+  """Number of positions at which each variant differs from its original."""
+  return _mismatch_matrix(variants, originals)[2].sum(axis=1)
+
+def _mismatch_codes(voframe):
+  """Return (mm_idx, orig_code, vari_code, gc_cont) arrays for each pair.
+
+  Raises ValueError unless every variant differs from its original at exactly
+  one position.
+  """
+  vari, orig, diff = _mismatch_matrix(voframe.variant, voframe.original)
+  nmm = diff.sum(axis=1)
+  for problem, bad in (('too many mismatches', nmm > 1),
+                       ('no mismatch', nmm < 1)):
+    if bad.any():
+      i = bad.argmax()
+      vari, orig = voframe.variant.iloc[i], voframe.original.iloc[i]
+      template = '{problem} in pair {vari} <- {orig}'
       raise ValueError(template.format(**locals()))
-    features = dict()
-    features['mm_idx'] = mm_idx
-    mm_trans = ''.join([orig[mm_idx], vari[mm_idx]])
-    features['mm_trans'] = mm_trans
-    features['gc_cont'] = orig.count('G') + orig.count('C')
-    row = pd.Series(features)
-    return row
-  return encoder
+  rows = np.arange(len(diff))
+  mm_idx = diff.argmax(axis=1)
+  orig_code = _BASE_CODES[orig[rows, mm_idx]]
+  vari_code = _BASE_CODES[vari[rows, mm_idx]]
+  gc_cont = np.isin(orig, np.frombuffer(b'GC', dtype=np.uint8)).sum(axis=1)
+  return mm_idx, orig_code, vari_code, gc_cont
+
+def _encode_mismatches(voframe):
+  """Return the linear model's feature frame for single-mismatch pairs.
+
+  Rows are indexed by variant, with columns gc_cont, mm_idx_0..19 and
+  mm_trans_AA..TT (one-hot).
+  """
+  mm_idx, orig_code, vari_code, gc_cont = _mismatch_codes(voframe)
+  nbases = len(_BASES)
+  mm_trans = np.where((orig_code < nbases) & (vari_code < nbases),
+                      orig_code * nbases + vari_code, -1)
+  rows = np.arange(len(mm_idx))
+  onehot = np.zeros((len(rows), _GUIDELEN + len(_TRANSITIONS)), dtype=bool)
+  known = (mm_idx < _GUIDELEN)
+  onehot[rows[known], mm_idx[known]] = True
+  known = (mm_trans >= 0)
+  onehot[rows[known], _GUIDELEN + mm_trans[known]] = True
+  columns = ['mm_idx_{0}'.format(i) for i in range(_GUIDELEN)]
+  columns += ['mm_trans_{0}'.format(t) for t in _TRANSITIONS]
+  index = pd.Index(voframe.variant, name='variant')
+  features = pd.DataFrame(onehot, index=index, columns=columns)
+  features.insert(0, 'gc_cont', gc_cont.astype(np.int64))
+  return features
 
 def train_and_save_mismatch_model(voframe, yframe):
   if voframe.shape[0] != yframe.shape[0]:
@@ -83,10 +138,7 @@ def train_and_save_mismatch_model(voframe, yframe):
   if 'variant' not in voframe.columns or 'original' not in voframe.columns:
     logging.fatal('voframe missing variant and/or original')
     sys.exit(2)
-  encoder = _get_linear_encoder()
-  encodings = voframe.apply(encoder, axis=1)
-  Xframe = encodings.set_index(voframe.variant)
-  Xframe = _expand_dummies(Xframe)
+  Xframe = _encode_mismatches(voframe)
   X = np.array(Xframe, dtype=float)
   y = np.array(yframe.y, dtype=float).reshape(-1, 1)
   shutil.rmtree(MODELDIR, ignore_errors=True)
@@ -104,6 +156,9 @@ def train_and_save_mismatch_model(voframe, yframe):
   joblib.dump(X_scaler, XS_FILE)
   joblib.dump(y_scaler, YS_FILE)
   joblib.dump(model, MODELFILE)
+  _save_linear_model(*_fold_linear_model(model, X_scaler, y_scaler),
+                     Xframe.columns)
+
 def _retrieve_mismatch_model():
   try:
     return (joblib.load(MODELFILE), joblib.load(XS_FILE), joblib.load(YS_FILE))
@@ -111,26 +166,287 @@ def _retrieve_mismatch_model():
     logging.fatal('Tried to make predictions without a model in place')
     sys.exit(2)
 
-def predict_mismatch_scores(reference):
+def _fold_linear_model(model, xscaler, yscaler):
+  """Fold the scalers into the Dense(1) weights.
+
+  Returns (coef, intercept) such that X.dot(coef) + intercept equals
+  yscaler.inverse_transform(model.predict(xscaler.transform(X))).
+  """
+  kernel, bias = model.get_weights()
+  weights = kernel[:, 0] / xscaler.scale_
+  coef = weights * yscaler.scale_[0]
+  intercept = (bias[0] - weights.dot(xscaler.mean_)) * yscaler.scale_[0]
+  intercept += yscaler.mean_[0]
+  return coef, intercept
+
+def _save_linear_model(coef, intercept, columns):
+  np.savez(LINEAR_FILE, coef=coef, intercept=intercept,
+           columns=np.array(columns, dtype=str))
+
+def export_linear_model():
+  """Write LINEAR_FILE from the trained keras model and scalers."""
+  model, xscaler, yscaler = _retrieve_mismatch_model()
+  columns = _encode_mismatches(pd.DataFrame(columns=['variant', 'original']))
+  _save_linear_model(*_fold_linear_model(model, xscaler, yscaler),
+                     columns.columns)
+  logging.info('Wrote linear model to {0}'.format(LINEAR_FILE))
+
+@functools.lru_cache(maxsize=None)
+def _retrieve_linear_model():
+  """Return (coef, intercept) from LINEAR_FILE, or folded from keras."""
+  try:
+    with np.load(LINEAR_FILE) as linear:
+      columns = linear['columns']
+      coef, intercept = linear['coef'], float(linear['intercept'])
+  except FileNotFoundError:
+    logging.warning('No {0}; loading keras model instead.'.format(LINEAR_FILE))
+    coef, intercept = _fold_linear_model(*_retrieve_mismatch_model())
+    return coef, intercept
+  expected = _encode_mismatches(pd.DataFrame(columns=['variant', 'original']))
+  if list(columns) != list(expected.columns):
+    logging.fatal('{0} does not match the feature encoding'.format(LINEAR_FILE))
+    sys.exit(2)
+  return coef, intercept
+
+@functools.lru_cache(maxsize=None)
+def _score_tables():
+  """Padded score tensor and GC coefficient of the linear model.
+
+  The tensor is indexed [mm_idx, orig_code, vari_code], with a final all-zero
+  slot on each axis for positions past the guide and non-ACGT bases (whose
+  one-hot features are all zero).
+  """
+  coef, intercept = _retrieve_linear_model()
+  nbases = len(_BASES)
+  idx_coef = np.zeros(_GUIDELEN + 1)
+  idx_coef[:_GUIDELEN] = coef[1:_GUIDELEN+1]
+  trans_coef = np.zeros((nbases + 1, nbases + 1))
+  trans_coef[:nbases, :nbases] = coef[_GUIDELEN+1:].reshape(nbases, nbases)
+  table = intercept + idx_coef[:, None, None] + trans_coef[None, :, :]
+  return table, coef[0]
+
+def mismatch_score_table():
+  """Return (table, gc_coef) for the linear model.
+
+  The predicted score of a single-mismatch variant is
+  table[mm_idx, orig_base, variant_base] + gc_coef * gc_cont(original), with
+  bases indexed in ACGT order.
+  """
+  table, gc_coef = _score_tables()
+  nbases = len(_BASES)
+  return table[:_GUIDELEN, :nbases, :nbases].copy(), gc_coef
+
+def _score_by_table(voframe):
+  mm_idx, orig_code, vari_code, gc_cont = _mismatch_codes(voframe)
+  table, gc_coef = _score_tables()
+  mm_idx = np.minimum(mm_idx, _GUIDELEN)
+  return table[mm_idx, orig_code, vari_code] + gc_coef * gc_cont
+
+def score_single_variants(parents):
+  """Score every single-base substitution of each parent by table lookup.
+
+  Returns an array of shape (len(parents), guidelen, 4), where [i, pos, b] is
+  the predicted score of parents[i] with base 'ACGT'[b] at pos.  Entries for
+  a parent's own base are NaN.
+  """
+  codes = _BASE_CODES[_as_base_matrix(parents)]
+  table, gc_coef = _score_tables()
+  nbases = len(_BASES)
+  gc_cont = np.isin(codes, [_BASES.index('G'), _BASES.index('C')]).sum(axis=1)
+  positions = np.minimum(np.arange(codes.shape[1]), _GUIDELEN)
+  scores = table[positions[None, :], codes, :nbases]
+  scores += gc_coef * gc_cont[:, None, None]
+  own = np.nonzero(codes < nbases)
+  scores[own + (codes[own],)] = np.nan
+  return scores
+
+def model_fingerprint():
+  """Hash of the model files, which changes whenever MODELDIR is rewritten."""
+  digest = hashlib.sha1()
+  for modelfile in (MODELFILE, XS_FILE, YS_FILE, LINEAR_FILE):
+    if modelfile.exists():
+      digest.update(modelfile.name.encode())
+      digest.update(modelfile.read_bytes())
+  return digest.hexdigest()
+
+
+def _pair_keys(variants, originals, widths):
+  """Fixed-width bytes keys joining each variant and original."""
+  variants = np.asarray(variants, dtype='S{0}'.format(widths[0]))
+  originals = np.asarray(originals, dtype='S{0}'.format(widths[1]))
+  n = len(variants)
+  joined = np.concatenate([variants.view(np.uint8).reshape(n, widths[0]),
+                           originals.view(np.uint8).reshape(n, widths[1])],
+                          axis=1)
+  return joined.view('S{0}'.format(sum(widths))).ravel()
+
+class PredictionCache(object):
+  """Persistent store of predicted scores, keyed by (variant, original).
+
+  Each model (by fingerprint) gets its own subdirectory of npz shards, each
+  holding the scores added by one store().  Shards are written under a
+  temporary name and renamed into place, so processes can share a cache
+  without locking.  Once a model has more than max_shards, they are merged
+  into one holding its newest max_rows scores, and other models' directories
+  are evicted if unused for max_age seconds, or (least recently used first)
+  while the cache is over max_bytes.  Lookups search a sorted array of keys.
+  """
+  def __init__(self, path=PREDICTION_CACHE, max_rows=CACHE_MAX_ROWS,
+               max_shards=CACHE_MAX_SHARDS, max_age=CACHE_MAX_AGE,
+               max_bytes=CACHE_MAX_BYTES):
+    self.root = pathlib.Path(path)
+    if self.root.exists() and not self.root.is_dir():
+      template = 'Prediction cache {self.root} is not a directory'
+      logging.fatal(template.format(**locals()))
+      sys.exit(2)
+    self.max_rows = max_rows
+    self.max_shards = max_shards
+    self.max_age = max_age
+    self.max_bytes = max_bytes
+    self.fingerprint = model_fingerprint()
+    self.path = self.root / self.fingerprint
+    self.path.mkdir(parents=True, exist_ok=True)
+    # mark this model's predictions as recently used, for _evict
+    os.utime(self.path)
+    self.variants, self.originals, self.scores = self._load(self._shards())
+    self._index = None
+
+  def _shards(self):
+    return sorted(self.path.glob('*.npz'))
+
+  def _load(self, shards):
+    """(variants, originals, scores) stored in shards, oldest first."""
+    columns = [[np.array([], dtype='S1')], [np.array([], dtype='S1')],
+               [np.array([])]]
+    for shard in shards:
+      try:
+        with np.load(shard) as stored:
+          for column, key in zip(columns, ['variant', 'original', 'score']):
+            column.append(stored[key])
+      except (OSError, ValueError, zipfile.BadZipFile):
+        # merged away by another process since we listed it
+        continue
+    return tuple(np.concatenate(column) for column in columns)
+
+  def _write(self, shard, variants, originals, scores):
+    partial = shard.with_suffix('.{0}.tmp'.format(os.getpid()))
+    with open(partial, 'wb') as handle:
+      np.savez(handle, variant=variants, original=originals, score=scores)
+    os.replace(partial, shard)
+
+  def _sorted_keys(self, widths):
+    if self._index is None or self._index[0] != widths:
+      keys = _pair_keys(self.variants, self.originals, widths)
+      order = np.argsort(keys, kind='stable')
+      self._index = (widths, keys[order], self.scores[order])
+    return self._index[1:]
+
+  def lookup(self, voframe):
+    """Return an array of cached scores for voframe rows, NaN if not cached."""
+    scores = np.full(len(voframe), np.nan)
+    if not len(voframe) or not len(self.scores):
+      return scores
+    variants = np.asarray(voframe.variant.values, dtype=bytes)
+    originals = np.asarray(voframe.original.values, dtype=bytes)
+    widths = (max(variants.itemsize, self.variants.itemsize),
+              max(originals.itemsize, self.originals.itemsize))
+    keys, known = self._sorted_keys(widths)
+    wanted = _pair_keys(variants, originals, widths)
+    found = np.searchsorted(keys, wanted).clip(max=len(keys) - 1)
+    hits = keys[found] == wanted
+    scores[hits] = known[found[hits]]
+    return scores
+
+  def store(self, voframe, scores):
+    variants = np.asarray(voframe.variant.values, dtype=bytes)
+    originals = np.asarray(voframe.original.values, dtype=bytes)
+    scores = np.asarray(scores, dtype=float)
+    name = '{0:020d}.{1}.npz'.format(time.time_ns(), os.getpid())
+    self._write(self.path / name, variants, originals, scores)
+    self.variants = np.concatenate([self.variants, variants])
+    self.originals = np.concatenate([self.originals, originals])
+    self.scores = np.concatenate([self.scores, scores])
+    self._index = None
+    shards = self._shards()
+    if len(shards) > self.max_shards:
+      self._merge(shards)
+
+  def _merge(self, shards):
+    """Replace shards (oldest first) with one holding their newest scores."""
+    variants, originals, scores = self._load(shards)
+    widths = (variants.itemsize, originals.itemsize)
+    keys = _pair_keys(variants, originals, widths)
+    # keep the last copy of each pair, then the last max_rows pairs
+    _, last = np.unique(keys[::-1], return_index=True)
+    keep = np.sort(len(keys) - 1 - last)[-self.max_rows:]
+    self._write(shards[-1], variants[keep], originals[keep], scores[keep])
+    for shard in shards[:-1]:
+      shard.unlink(missing_ok=True)
+    self._evict()
+
+  def _evict(self):
+    """Remove other models' directories that are stale, or over max_bytes."""
+    others = list()
+    total = 0
+    for entry in self.root.iterdir():
+      try:
+        if not entry.is_dir():
+          continue
+        size = sum(shard.stat().st_size for shard in entry.iterdir())
+        used = entry.stat().st_mtime
+      except OSError:
+        # evicted by another process as we looked
+        continue
+      total += size
+      if entry != self.path:
+        others.append((used, size, entry))
+    now = time.time()
+    for used, size, entry in sorted(others):
+      if now - used <= self.max_age and total <= self.max_bytes:
+        break
+      template = 'Evicting predictions of model {entry.name} from {self.root}'
+      logging.info(template.format(**locals()))
+      shutil.rmtree(entry, ignore_errors=True)
+      total -= size
+
+
+def _score_children(children, mode):
+  if mode == 'table':
+    return _score_by_table(children)
+  coef, intercept = _retrieve_linear_model()
+  Xframe = _encode_mismatches(children)
+  X = np.array(Xframe, dtype=float)
+  return X.dot(coef) + intercept
+
+def predict_mismatch_scores(reference, mode='table', cache=None):
+  """Predict knockdown for each (variant, original) row of reference.
+
+  mode 'table' sums entries of the precomputed score table; 'features' builds
+  the full feature matrix.  Both give the same scores.  If cache (a
+  PredictionCache) is given, only pairs missing from it are scored.
+  """
   if 'variant' not in reference.columns or 'original' not in reference.columns:
     logging.fatal('reference missing variant and/or original')
     sys.exit(2)
   refsize = len(reference)
   logging.info('Applying model to {refsize} guides...'.format(**locals()))
-  model, xscaler, yscaler = _retrieve_mismatch_model()
-  encoder = _get_linear_encoder()
   voframe = reference[['variant', 'original']]
   voframe = voframe.drop_duplicates()
   matchmask = (voframe.variant == voframe.original)
   parents = pd.DataFrame(voframe.loc[matchmask])
   parents['score'] = 1.0
   children = pd.DataFrame(voframe.loc[~matchmask])
-  encodings = children.apply(encoder, axis=1)
-  Xframe = encodings.set_index(children.variant)
-  Xframe = _expand_dummies(Xframe)
-  X = np.array(Xframe, dtype=float)
-  X = xscaler.transform(X)
-  children['score'] = yscaler.inverse_transform(model.predict(X))
+  if cache is None:
+    children['score'] = _score_children(children, mode)
+  else:
+    scores = cache.lookup(children)
+    missing = np.isnan(scores)
+    nmissing = missing.sum()
+    logging.info('...{nmissing} guides not in prediction cache'.format(**locals()))
+    if nmissing:
+      scores[missing] = _score_children(children.loc[missing], mode)
+      cache.store(children.loc[missing], scores[missing])
+    children['score'] = scores
   both = pd.concat([parents, children], axis='rows')
   reconcile = pd.merge(reference, both, on='variant', how='left')
   return reconcile.score
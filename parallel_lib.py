@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import collections
+import concurrent.futures
+import logging
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+def ordered_map(fn, iterable, jobs, initializer=None, initargs=()):
+  """Like map(), but across jobs processes with at most 2*jobs in flight.
+
+  initializer(*initargs) is run once in each worker process, e.g. to hand
+  it state too large to send with every item.  With jobs <= 1, everything
+  runs in this process and initializer is not called.
+  """
+  if jobs <= 1:
+    yield from map(fn, iterable)
+    return
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=jobs, initializer=initializer,
+      initargs=initargs) as executor:
+    pending = collections.deque()
+    for item in iterable:
+      pending.append(executor.submit(fn, item))
+      if len(pending) >= 2 * jobs:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
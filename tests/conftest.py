@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import pathlib
+import sys
+
+# the libraries live at the top of the repository, next to the scripts
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import random
+
+import numpy as np
+import pandas as pd
+
+import choice_lib as cl
+
+def binned_frame(per_bin):
+  """A single-locus frame with per_bin variants in each prediction bin."""
+  centers = [0.05, 0.3, 0.5, 0.7, 0.95]
+  y_pred = np.repeat(centers, per_bin)
+  variants = ['V{0:04d}'.format(i) for i in range(len(y_pred))]
+  return pd.DataFrame({'variant': variants, 'locus_tag': 'BSU00010',
+                       'y_pred': y_pred})
+
+def chosen_bins(data, chosen):
+  bins = cl.bin_preds(data.y_pred.values, cl.pred_bins())
+  picked = data.variant.isin(chosen).values
+  return np.bincount(bins[picked], minlength=cl.NBINS)
+
+def test_bins_reserved_only_above_zero():
+  # with every bin full, quotas of 3 for bins 1-3 and 2 for the top bin leave
+  # 2 picks for the fill, which prefers bins below the top one
+  data = binned_frame(50)
+  chosen = cl.choose_n_by_bin(data, 'y_pred', 13, random.Random(0))
+  assert len(chosen) == 13
+  counts = chosen_bins(data, chosen)
+  assert (counts[1:4] >= 3).all()
+  assert counts[-1] == 2
+  assert counts.sum() == 13
+
+def test_full_bins_default_n():
+  data = binned_frame(60)
+  for seed in range(5):
+    chosen = cl.choose_n_by_bin(data, 'y_pred', 100, random.Random(seed))
+    assert len(chosen) == 100
+
+def test_same_rng_same_choice():
+  data = binned_frame(30)
+  first = cl.choose_n_by_bin(data, 'y_pred', 20, random.Random(7))
+  second = cl.choose_n_by_bin(data, 'y_pred', 20, random.Random(7))
+  assert first == second
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import gzip
+import random
+
+import count_lib as ctl
+
+GUIDES = ['ACGTACGTACGTACGTACGT', 'TTTTGGGGCCCCAAAATTTT',
+          'GATTACAGATTACAGATTAC']
+
+class Skips(object):
+  def __init__(self):
+    self.lines = list()
+
+  def add(self, lines):
+    self.lines.extend(lines)
+
+def write_fastq(filename, nreads, seed=0):
+  """Reads of GUIDES (some unmatched), with "@" quality lines and blanks."""
+  rng = random.Random(seed)
+  out = list()
+  for i in range(nreads):
+    seq = rng.choice(GUIDES) + ctl.FORWARD_TAIL.decode() + 'CTAGAAAT'
+    if rng.random() < 0.1:
+      seq = 'A' * len(seq)
+    qual = (i % 3 and 'I' or '@') * len(seq)
+    out.append('@r{i} desc\n{seq}\n+\n{qual}\n'.format(**locals()))
+    if i % 5 == 0:
+      out.append('\n')
+  opener = str(filename).endswith('.gz') and gzip.open or open
+  with opener(filename, 'wt') as handle:
+    handle.write(''.join(out))
+
+def test_ranges_start_at_records(tmp_path):
+  filename = tmp_path / 'reads.fastq'
+  write_fastq(filename, 200)
+  data = filename.read_bytes()
+  ranges = list(ctl.fastq_ranges(filename, chunk_size=7))
+  assert len(ranges) > 10
+  assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+  for (_, end), (start, _) in zip(ranges, ranges[1:]):
+    assert end == start
+    assert data[start:start + 2] == b'@r'
+
+def test_blocks_start_at_records(tmp_path):
+  filename = tmp_path / 'reads.fastq.gz'
+  write_fastq(filename, 200)
+  with ctl.open_fastq(filename) as handle:
+    blocks = list(ctl.fastq_blocks(handle, chunk_size=7))
+  assert len(blocks) > 10
+  assert b''.join(blocks) == gzip.decompress(filename.read_bytes())
+  assert all(block.startswith(b'@r') for block in blocks)
+
+def test_ranges_count_like_one_stream(tmp_path):
+  plain = tmp_path / 'reads.fastq'
+  packed = tmp_path / 'reads.fastq.gz'
+  write_fastq(plain, 500)
+  write_fastq(packed, 500)
+  results = list()
+  for filename, jobs, chunk_size in [(packed, 1, 10000), (plain, 1, 10000),
+                                     (plain, 2, 13), (plain, 1, 1),
+                                     (packed, 2, 13), (packed, 1, 1)]:
+    skips = Skips()
+    counts, reads = ctl.count_fastq(filename, GUIDES[:1], skips, jobs=jobs,
+                                    chunk_size=chunk_size, batch=True)
+    results.append((list(counts.items()), reads, skips.lines))
+  assert results[0][1] == 500
+  assert all(result == results[0] for result in results)
+
+def test_guide_ids_skip_blanks_and_repeats(tmp_path):
+  guide_set = tmp_path / 'guides'
+  guide_set.write_text('\n'.join([GUIDES[0], '', GUIDES[1], GUIDES[0] + ' ',
+                                  GUIDES[2], '']) + '\n')
+  guides = ctl.load_guide_index(guide_set)
+  assert list(guides) == GUIDES
+  assert guides.get_loc(GUIDES[2]) == 2
+
+def test_batch_block_matches_stream():
+  # tidy records (no blank lines), so count_block_batch takes its numpy path
+  rng = random.Random(1)
+  tail = ctl.FORWARD_TAIL.decode()
+  header = ctl.REVERSE_HEADER.decode()
+  records = list()
+  for i in range(300):
+    guide = rng.choice(GUIDES)
+    seq = rng.choice([guide + tail + 'CTAG', tail + guide, 'A' * 30,
+                      'C' + header + guide[:rng.randrange(21)],
+                      header + guide + 'ACAT', guide])
+    qual = ''.join(rng.choice('ACGTI@+') for _ in seq)
+    records.append('@r{i}\n{seq}\n+\n{qual}\n'.format(**locals()))
+  data = ''.join(records).encode()
+  for reverse in [False, True]:
+    counts, skipped = ctl.count_block(data, reverse)
+    batch_counts, batch_skipped = ctl.count_block_batch(data, reverse)
+    assert list(batch_counts.items()) == list(counts.items())
+    assert batch_skipped == skipped
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import io_lib as iol
+
+pytest.importorskip('pyarrow')
+
+COLUMNS = ['variant', 'original', 'locus_tag', 'y_pred']
+
+def batch(n, start=0):
+  return pd.DataFrame({
+      'variant': ['V{0}'.format(i) for i in range(start, start + n)],
+      'original': ['P{0}'.format(i // 3) for i in range(start, start + n)],
+      'locus_tag': 'BSU00010',
+      'y_pred': np.linspace(0, 1, n)})
+
+def test_empty_frame_first(tmp_path):
+  filename = tmp_path / 'chosen.parquet'
+  empty = pd.DataFrame({k: pd.Series([], dtype=object) for k in COLUMNS})
+  with iol.TableWriter(filename) as writer:
+    writer.write(empty)
+    writer.write(batch(5))
+    writer.write(empty)
+    writer.write(batch(4, start=5))
+  frame = iol.read_table(filename)
+  assert list(frame.columns) == COLUMNS
+  assert list(frame.variant.astype(str)) == ['V{0}'.format(i) for i in range(9)]
+  assert frame.y_pred.dtype == np.float32
+
+def test_missing_column_first(tmp_path):
+  filename = tmp_path / 'chosen.parquet'
+  first = batch(3)
+  first['original'] = None
+  with iol.TableWriter(filename) as writer:
+    writer.write(first)
+    writer.write(batch(3, start=3))
+  frame = iol.read_table(filename)
+  assert len(frame) == 6
+  assert frame.original.isna().sum() == 3
+
+def test_only_empty_frames(tmp_path):
+  filename = tmp_path / 'chosen.parquet'
+  empty = pd.DataFrame({k: pd.Series([], dtype=object) for k in COLUMNS})
+  with iol.TableWriter(filename) as writer:
+    writer.write(empty)
+  frame = iol.read_table(filename)
+  assert list(frame.columns) == COLUMNS
+  assert len(frame) == 0
+
+def test_tsv_round_trip(tmp_path):
+  filename = tmp_path / 'chosen.tsv'
+  with iol.TableWriter(filename) as writer:
+    writer.write(batch(2))
+    writer.write(batch(2, start=2))
+  frame = iol.read_table(filename)
+  assert list(frame.variant) == ['V0', 'V1', 'V2', 'V3']
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import numpy as np
+import pytest
+
+import metrics_lib as mtl
+
+def test_stage_peak_is_per_stage():
+  if mtl.rss_mb() is None:
+    pytest.skip('no /proc/self/statm')
+  metrics = mtl.Metrics('test')
+  with metrics.stage('big'):
+    block = np.ones(64 << 20, dtype=np.uint8)
+  del block
+  with metrics.stage('small'):
+    pass
+  big = metrics.stages['big']['peak_rss_mb']
+  small = metrics.stages['small']['peak_rss_mb']
+  assert big - small > 48
+
+def test_sampler_falls_back_without_proc(monkeypatch):
+  monkeypatch.setattr(mtl, 'STATM', '/nonexistent/statm')
+  assert mtl.RSSSampler().start().stop() == mtl.peak_rss_mb()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import model_lib as ml
+
+def pairs(n, start=0):
+  numbers = range(start, start + n)
+  variants = ['{0:020d}'.format(i).replace('0', 'A') for i in numbers]
+  originals = ['C' * 19 + 'GT'[i % 2] for i in numbers]
+  return pd.DataFrame({'variant': variants, 'original': originals})
+
+def test_cache_round_trip(tmp_path):
+  cache = ml.PredictionCache(tmp_path / 'predictions')
+  first = pairs(10)
+  assert np.isnan(cache.lookup(first)).all()
+  cache.store(first.iloc[:6], np.arange(6.0))
+  # a fresh cache sees what the first stored
+  again = ml.PredictionCache(tmp_path / 'predictions')
+  scores = again.lookup(first.iloc[::-1])
+  assert np.isnan(scores[:4]).all()
+  assert list(scores[4:]) == [5.0, 4.0, 3.0, 2.0, 1.0, 0.0]
+
+def test_cache_wider_query(tmp_path):
+  cache = ml.PredictionCache(tmp_path / 'predictions')
+  cache.store(pairs(3), [0.5, 0.25, 0.125])
+  query = pd.concat([pairs(3), pd.DataFrame({'variant': ['A' * 23],
+                                            'original': ['C' * 23]})])
+  scores = cache.lookup(query)
+  assert list(scores[:3]) == [0.5, 0.25, 0.125]
+  assert np.isnan(scores[3])
+
+def test_cache_merges_shards(tmp_path):
+  cache = ml.PredictionCache(tmp_path / 'predictions', max_rows=15,
+                             max_shards=2)
+  for i in range(4):
+    cache.store(pairs(5, start=5 * i), np.full(5, float(i)))
+  cache.store(pairs(1), [9.0])
+  assert len(list((tmp_path / 'predictions').glob('*/*.npz'))) <= 2
+  scores = ml.PredictionCache(tmp_path / 'predictions').lookup(pairs(20))
+  # the newest copy of a pair wins, and only the newest 15 pairs are kept
+  assert scores[0] == 9.0
+  assert np.isnan(scores[1:6]).all()
+  assert list(scores[6:]) == [1.0] * 4 + [2.0] * 5 + [3.0] * 5
+
+def test_cache_kept_per_model(tmp_path, monkeypatch):
+  cache = ml.PredictionCache(tmp_path / 'predictions')
+  cache.store(pairs(3), [0.5, 0.25, 0.125])
+  fingerprint = ml.model_fingerprint()
+  monkeypatch.setattr(ml, 'model_fingerprint', lambda: 'other')
+  other = ml.PredictionCache(tmp_path / 'predictions')
+  assert np.isnan(other.lookup(pairs(3))).all()
+  other.store(pairs(3), [1.0, 1.0, 1.0])
+  # the first model's predictions survive another model using the cache
+  monkeypatch.setattr(ml, 'model_fingerprint', lambda: fingerprint)
+  cache = ml.PredictionCache(tmp_path / 'predictions')
+  assert list(cache.lookup(pairs(3))) == [0.5, 0.25, 0.125]
+
+def test_cache_evicts_unused_models(tmp_path, monkeypatch):
+  root = tmp_path / 'predictions'
+  for name in ['old', 'recent']:
+    monkeypatch.setattr(ml, 'model_fingerprint', lambda: name)
+    ml.PredictionCache(root).store(pairs(3), [0.5, 0.25, 0.125])
+  os.utime(root / 'old', (0, 0))
+  monkeypatch.setattr(ml, 'model_fingerprint', lambda: 'current')
+  cache = ml.PredictionCache(root, max_shards=1)
+  cache.store(pairs(1), [1.0])
+  assert len(list(root.iterdir())) == 3
+  # eviction waits for a merge, the second shard
+  cache.store(pairs(1), [1.0])
+  assert sorted(entry.name for entry in root.iterdir()) == ['current', 'recent']
+  # over max_bytes, the least recently used go first, but never our own
+  cache = ml.PredictionCache(root, max_shards=1, max_bytes=0)
+  cache.store(pairs(1), [1.0])
+  cache.store(pairs(1), [1.0])
+  assert [entry.name for entry in root.iterdir()] == ['current']